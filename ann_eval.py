@@ -0,0 +1,68 @@
+import tensorflow as tf
+import importlib
+import os
+import time
+import numpy as np
+from target_simulation import Target_Simulation
+from utils.ann_index import load_ann_index
+from utils.retrieval_engine import MIPSEngine
+
+
+class QueryRecorder:
+    """Forwards the searches of an agent to `engine` and keeps the queries."""
+    def __init__(self, engine):
+        self.engine = engine
+        self.queries = []
+
+    def search(self, queries, k):
+        self.queries.append(queries)
+        return self.engine.search(queries, k)
+
+
+def recall(approx, exact):
+    return np.mean([len(np.intersect1d(a, e)) / len(e) for a, e in zip(approx, exact)])
+
+
+if __name__ == '__main__':
+    flags = tf.flags
+    flags.DEFINE_string('dataset', 'TGPC', 'The dataset, supports TGPC / CWC.')
+    flags.DEFINE_string('agent', 'neural_dkr', 'The agent type, \
+        supports neural_dkr / kernel / matrix / neural / retrieval / retrieval_stgy.')
+    flags.DEFINE_integer('times', 50, 'Simulation times used to collect the queries.')
+    flags.DEFINE_string('nprobe', '1,4,16,32,64,128', 'Comma separated numbers of probed lists.')
+    FLAGS = flags.FLAGS
+
+    # Target-Guided PersonaChat Dataset
+    if FLAGS.dataset == 'TGPC':
+        config_dir = 'config.'
+        os.environ['is_weibo'] = 'False'
+    # Chinese Weibo Conversation Dataset
+    elif FLAGS.dataset == 'CWC':
+        config_dir = 'config_weibo.'
+        os.environ['is_weibo'] = 'True'
+
+    config_data = importlib.import_module(config_dir + 'data_config')
+    config_model = importlib.import_module(config_dir + FLAGS.agent)
+    config_retrieval = importlib.import_module(config_dir + 'retrieval')
+    model = importlib.import_module('model.' + FLAGS.agent)
+
+    # collect the history codes the agent searches with during self-play
+    simulation = Target_Simulation(model, config_model, config_retrieval, config_data)
+    agent = simulation.agent
+    recorder = QueryRecorder(agent.retrieval_engine)
+    agent.retrieval_engine = recorder
+    simulation.self_play_simulation(FLAGS.times, print_details=False)
+    queries = np.concatenate(recorder.queries)
+    weight, bias = recorder.engine.weight, recorder.engine.bias
+    k = config_data._retrieval_candidates
+
+    exact_engine = MIPSEngine(agent.corpus_code, weight, bias)
+    start = time.time()
+    exact = exact_engine.search(queries, k)
+    print('{} queries, exact: {:.2f} ms/query'.format(len(queries), (time.time() - start) * 1000 / len(queries)))
+    index = load_ann_index(agent.index_path, agent.corpus_code, weight, bias, config_data)
+    for nprobe in [int(x) for x in FLAGS.nprobe.split(',')]:
+        start = time.time()
+        approx = index.search(queries, k, nprobe)
+        print('nprobe={}, recall@{}={:.4f}, {:.2f} ms/query'.format(
+            nprobe, k, recall(approx, exact), (time.time() - start) * 1000 / len(queries)))
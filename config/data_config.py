@@ -8,7 +8,12 @@ _max_seq_len = 30
 _num_neg = 20
 _max_turns = 8
 _batch_size = 64
+_pretokenized_data = False  # read the datasets from TFRecord shards of token ids, converted on first use
 _retrieval_candidates = 1000
+_ann_index = False  # retrieve from an approximate IVF-PQ index instead of scanning the whole corpus
+_ann_lists = 1024
+_ann_subspace_dim = 8
+_ann_nprobe = 32
 
 data_hparams = {
     stage: {
@@ -1,14 +1,11 @@
 _hidden_size = 200
 _code_len = 800
 _save_path = 'save_weibo/matrix/model_1'
-_matrix_save_path = 'save_weibo/matrix/matrix_1.pk'
+_matrix_save_path = 'save_weibo/matrix/matrix_1.npz'
 _conversation_save_path = 'save_weibo/matrix/logs/conversation_logs.txt'
 _simulation_save_path = 'save_weibo/matrix/logs/simulation_logs.txt'
 _max_epoch = 10
-
-_vocab_path = 'tx_data/vocab.txt'
-_vocab = [x.strip() for x in open(_vocab_path, 'r').readlines()]
-_vocab_size = len(_vocab)
+_pmi_processes = None  # processes counting the keyword co-occurrences, None for all CPUs
 
 source_encoder_hparams = {
     "encoder_minor_type": "BidirectionalRNNEncoder",
@@ -1,90 +1,96 @@
 import texar as tx
 import tensorflow as tf
 import numpy as np
-import pickle
+import os
+from utils.corpus_index import corpus_index_path, read_corpus, load_corpus_index, CorpusIndexWriter
+from utils.ann_index import build_retrieval_engine
+from utils.vocab_utils import load_vocab, build_word_embedder
+from utils.dataset_cache import make_aligned_data
+from utils.eval_utils import StreamingEvaluator, KeywordMetrics, RankMetrics, format_metrics
+from utils.keyword_ops import keyword_labels, keyword_accuracy, keyword_token_ids
+from utils.checkpoint_utils import export_checkpoint, inference_checkpoint
+from utils.metrics_utils import metrics, agent_labels
+from utils.pmi_utils import build_pmi_matrix, save_pmi_matrix, load_pmi_matrix
 
 class Predictor():
     def __init__(self, config_model, config_data, mode=None):
         self.config = config_model
         self.data_config = config_data
+        self.metric_labels = agent_labels(__name__)
         self.gpu_config = tf.ConfigProto()
         self.gpu_config.gpu_options.allow_growth = True
+        self.mode = mode
         self.build_model(mode)
 
     def build_model(self, mode):
-        self.train_data = tx.data.MultiAlignedData(self.data_config.data_hparams['train'])
-        self.valid_data = tx.data.MultiAlignedData(self.data_config.data_hparams['valid'])
-        self.test_data = tx.data.MultiAlignedData(self.data_config.data_hparams['test'])
-        self.iterator = tx.data.TrainTestDataIterator(train=self.train_data, val=self.valid_data, test=self.test_data)
-        self.vocab = self.train_data.vocab(0)
+        if mode == 'infer':
+            # serving restores the embeddings from the checkpoint and needs no datasets
+            self.train_data = None
+            self.vocab = load_vocab(self.data_config)
+        else:
+            self.train_data = make_aligned_data(self.data_config, 'train')
+            self.valid_data = make_aligned_data(self.data_config, 'valid')
+            self.test_data = make_aligned_data(self.data_config, 'test')
+            self.iterator = tx.data.TrainTestDataIterator(train=self.train_data, val=self.valid_data, test=self.test_data)
+            self.vocab = self.train_data.vocab(0)
         self.source_encoder = tx.modules.HierarchicalRNNEncoder(hparams=self.config.source_encoder_hparams)
         self.target_encoder = tx.modules.BidirectionalRNNEncoder(hparams=self.config.target_encoder_hparams)
         self.target_kwencoder = tx.modules.BidirectionalRNNEncoder(hparams=self.config.target_kwencoder_hparams)
         self.linear_transform = tx.modules.MLPTransformConnector(self.config._code_len // 2)
         self.linear_matcher = tx.modules.MLPTransformConnector(1)
-        self.embedder = tx.modules.WordEmbedder(init_value=self.train_data.embedding_init_value(0).word_vecs)
+        self.embedder = build_word_embedder(self.data_config, self.vocab, self.train_data)
         self.kw_list = self.vocab.map_tokens_to_ids(tf.convert_to_tensor(self.data_config._keywords_candi))
         self.kw_vocab = tx.data.Vocab(self.data_config._keywords_path)
 
-        if mode == 'train_kw':
-            self.pmi_matrix = np.zeros([self.config._vocab_size+4, self.data_config._keywords_num])
-        else:
-            with open(self.config._matrix_save_path, 'rb') as f:
-                matrix = pickle.load(f)
-                self.pmi_matrix = tf.convert_to_tensor(matrix,dtype=tf.float32)
+        # built by train_keywords, or loaded by the first forward_matrix
+        self.pmi_matrix = None
+        self.pmi_tensors = None
 
-    def forward_matrix(self, context_ids):
-        matching_score = tf.gather(self.pmi_matrix, context_ids)
-        return tf.reduce_sum(tf.log(matching_score), axis=0)
+    def forward_matrix(self, context_ids, context_length=None):
+        """Returns the keyword scores of shape `[batch_size, keywords_num]`, the
+        sums of the log matrix rows of `context_ids`, or of their first
+        `context_length` ids when given.
+        """
+        if self.pmi_tensors is None:
+            if self.pmi_matrix is None:
+                self.pmi_matrix = load_pmi_matrix(self.config._matrix_save_path)
+            self.pmi_tensors = [tf.constant(x) for x in (self.pmi_matrix.default, self.pmi_matrix.indptr,
+                                                         self.pmi_matrix.indices, self.pmi_matrix.data)]
+        default, indptr, indices, data = self.pmi_tensors
+        batch_size, max_len = tf.shape(context_ids)[0], tf.shape(context_ids)[1]
+        if context_length is None:
+            num_words = tf.fill([batch_size], max_len)
+        else:
+            num_words = context_length
+            # the rows of the special tokens are empty, so the padding adds no entry
+            context_ids = tf.where(tf.sequence_mask(context_length, max_len), context_ids,
+                                   tf.zeros_like(context_ids))
+        # the stored entries of all the rows, summed per example and keyword
+        context_ids = tf.reshape(context_ids, [-1])
+        entries = tf.ragged.range(tf.gather(indptr, context_ids), tf.gather(indptr, context_ids + 1))
+        example_ids = entries.value_rowids() // tf.cast(max_len, tf.int64)
+        keyword_ids = tf.cast(tf.gather(indices, entries.flat_values), tf.int64)
+        num_keywords = tf.cast(tf.shape(default)[0], tf.int64)
+        offsets = tf.unsorted_segment_sum(tf.gather(data, entries.flat_values),
+                                          example_ids * num_keywords + keyword_ids,
+                                          tf.cast(batch_size, tf.int64) * num_keywords)
+        offsets = tf.reshape(offsets, [batch_size, -1])
+        return offsets + tf.expand_dims(tf.cast(num_words, tf.float32), 1) * default
 
     def predict_keywords(self, batch):
         keywords_ids = self.kw_vocab.map_tokens_to_ids(batch['keywords_text'])
-        matching_score = tf.map_fn(lambda x: self.forward_matrix(x), batch['context_text_ids'],
-             dtype=tf.float32, parallel_iterations=True)
-        kw_labels = tf.map_fn(lambda x: tf.sparse_to_dense(x, [self.kw_vocab.size], 1., 0., False),
-                              keywords_ids, dtype=tf.float32, parallel_iterations=True)[:, 4:]
+        matching_score = self.forward_matrix(batch['context_text_ids'])
+        kw_labels = keyword_labels(keywords_ids, self.kw_vocab.size)
         kw_ans = tf.arg_max(matching_score, -1)
-        acc_label = tf.map_fn(lambda x: tf.gather(x[0], x[1]), (kw_labels, kw_ans), dtype=tf.float32)
-        acc = tf.reduce_mean(acc_label)
+        acc = keyword_accuracy(kw_labels, kw_ans)
         kws = tf.nn.top_k(matching_score, k=5)[1]
-        kws = tf.reshape(kws,[-1])
-        kws = tf.map_fn(lambda x: self.kw_list[x], kws, dtype=tf.int64)
-        kws = tf.reshape(kws,[-1, 5])
+        kws = keyword_token_ids(self.kw_list, kws)
         return acc, kws
 
     def train_keywords(self):
-        batch = self.iterator.get_next()
-        acc, _ = self.predict_keywords(batch)
-        with tf.Session(config=self.gpu_config) as sess:
-            sess.run(tf.global_variables_initializer())
-            sess.run(tf.local_variables_initializer())
-            sess.run(tf.tables_initializer())
-            self.iterator.switch_to_train_data(sess)
-
-            batchid = 0
-            while True:
-                try:
-                    batchid += 1
-                    feed = {tx.global_mode(): tf.estimator.ModeKeys.TRAIN}
-                    source_keywords, target_keywords = sess.run([batch['context_text_ids'],
-                                                                   batch['keywords_text_ids']], feed_dict=feed)
-                    for i in range(len(source_keywords)):
-                        for skw_id in source_keywords[i]:
-                            if skw_id == 0:
-                                break
-                            for tkw_id in target_keywords[i]:
-                                if skw_id >= 3 and tkw_id >= 3:
-                                    tkw = self.config._vocab[tkw_id-4]
-                                    if tkw in self.data_config._keywords_candi:
-                                        tkw_id = self.data_config._keywords_dict[tkw]
-                                        self.pmi_matrix[skw_id][tkw_id] += 1
-
-                except tf.errors.OutOfRangeError:
-                    break
-            self.pmi_matrix += 0.5
-            self.pmi_matrix = self.pmi_matrix / (np.sum(self.pmi_matrix, axis=0) + 1)
-            with open(self.config._matrix_save_path,'wb') as f:
-                pickle.dump(self.pmi_matrix, f)
+        self.pmi_matrix = build_pmi_matrix(self.data_config, processes=self.config._pmi_processes)
+        save_pmi_matrix(self.pmi_matrix, self.config._matrix_save_path)
+        print('matrix saved in {}'.format(self.config._matrix_save_path))
 
     def test_keywords(self):
         batch = self.iterator.get_next()
@@ -94,37 +100,20 @@ class Predictor():
             sess.run(tf.local_variables_initializer())
             sess.run(tf.tables_initializer())
             self.iterator.switch_to_test_data(sess)
-            cnt_acc, cnt_rec1, cnt_rec3, cnt_rec5 = [], [], [], []
+            evaluator = StreamingEvaluator(KeywordMetrics())
             while True:
                 try:
                     feed = {tx.global_mode(): tf.estimator.ModeKeys.PREDICT}
-                    acc_, kw_ans, kw_labels = sess.run([acc, kws, batch['keywords_text_ids']], feed_dict=feed)
-                    cnt_acc.append(acc_)
-                    rec = [0,0,0,0,0]
-                    sum_kws = 0
-                    for i in range(len(kw_ans)):
-                        sum_kws += sum(kw_labels[i] > 3)
-                        for j in range(5):
-                            if kw_ans[i][j] in kw_labels[i]:
-                                for k in range(j, 5):
-                                    rec[k] += 1
-                    cnt_rec1.append(rec[0]/sum_kws)
-                    cnt_rec3.append(rec[2]/sum_kws)
-                    cnt_rec5.append(rec[4]/sum_kws)
-
+                    evaluator.add(*sess.run([acc, kws, batch['keywords_text_ids']], feed_dict=feed))
                 except tf.errors.OutOfRangeError:
-                    print('test_kw acc@1={:.4f}, rec@1={:.4f}, rec@3={:.4f}, rec@5={:.4f}'.format(
-                        np.mean(cnt_acc), np.mean(cnt_rec1), np.mean(cnt_rec3), np.mean(cnt_rec5)))
+                    print('test_kw ' + format_metrics(evaluator.result()))
                     break
 
 
     def forward(self, batch):
-        matching_score = tf.map_fn(lambda x: self.forward_matrix(x), batch['context_text_ids'],
-             dtype=tf.float32, parallel_iterations=True)
+        matching_score = self.forward_matrix(batch['context_text_ids'])
         kw_weight, predict_kw = tf.nn.top_k(matching_score, k=3)
-        predict_kw = tf.reshape(predict_kw, [-1])
-        predict_kw = tf.map_fn(lambda x: self.kw_list[x], predict_kw, dtype=tf.int64)
-        predict_kw = tf.reshape(predict_kw, [-1, 3])
+        predict_kw = keyword_token_ids(self.kw_list, predict_kw)
         embed_code = self.embedder(predict_kw)
         embed_code = tf.reduce_sum(embed_code, axis=1)
         embed_code = self.linear_transform(embed_code)
@@ -210,28 +199,16 @@ class Predictor():
             self.saver = tf.train.Saver()
             self.saver.restore(sess, self.config._save_path)
             self.iterator.switch_to_test_data(sess)
-            rank_cnt = []
+            evaluator = StreamingEvaluator(RankMetrics())
             while True:
                 try:
                     feed = {tx.global_mode(): tf.estimator.ModeKeys.PREDICT}
-                    ranks, labels = sess.run([rank, batch['label']], feed_dict=feed)
-                    for i in range(len(ranks)):
-                        rank_cnt.append(np.where(ranks[i]==labels[i])[0][0])
+                    evaluator.add(*sess.run([rank, batch['label']], feed_dict=feed))
                 except tf.errors.OutOfRangeError:
-                    rec = [0,0,0,0,0]
-                    MRR = 0
-                    for rank in rank_cnt:
-                        for i in range(5):
-                            rec[i] += (rank <= i)
-                        MRR += 1 / (rank+1)
-                    print('test rec1@20={:.4f}, rec3@20={:.4f}, rec5@20={:.4f}, MRR={:.4f}'.format(
-                        rec[0]/len(rank_cnt), rec[2]/len(rank_cnt), rec[4]/len(rank_cnt), MRR/len(rank_cnt)))
+                    print('test ' + format_metrics(evaluator.result()))
                     break
 
-    def retrieve_init(self, sess):
-        data_batch = self.iterator.get_next()
-        loss, acc, _ = self.forward(data_batch)
-        self.corpus = self.data_config._corpus
+    def build_corpus_encoder(self):
         self.corpus_data = tx.data.MonoTextData(self.data_config.corpus_hparams)
         corpus_iterator = tx.data.DataIterator(self.corpus_data)
         batch = corpus_iterator.get_next()
@@ -239,64 +216,162 @@ class Predictor():
         utter_code = self.target_encoder(corpus_embed, sequence_length=batch['corpus_length'])[1]
         utter_kwcode = self.target_kwencoder(corpus_embed, sequence_length=batch['corpus_length'])[1]
         utter_code = tf.concat([utter_code[0], utter_code[1], utter_kwcode[0], utter_kwcode[1]], -1)
-        self.corpus_code = np.zeros([0, self.config._code_len])
+        return corpus_iterator, utter_code
 
+    def encode_corpus(self, sess, corpus_iterator, utter_code, index_path):
+        """Encodes the whole corpus with the restored response encoders and
+        writes the codes to the corpus index at `index_path`.
+        """
         corpus_iterator.switch_to_dataset(sess)
-        sess.run(tf.tables_initializer())
-        saver = tf.train.Saver()
-        saver.restore(sess, self.config._save_path)
+        writer = CorpusIndexWriter(index_path, len(self.data_config._corpus), self.config._code_len)
         feed = {tx.global_mode(): tf.estimator.ModeKeys.PREDICT}
         while True:
             try:
-                utter_code_ = sess.run(utter_code, feed_dict=feed)
-                self.corpus_code = np.concatenate([self.corpus_code, utter_code_], axis=0)
+                writer.write(sess.run(utter_code, feed_dict=feed))
             except tf.errors.OutOfRangeError:
                 break
-        self.minor_length_input = tf.placeholder(dtype=tf.int32, shape=(1, 9))
-        self.major_length_input = tf.placeholder(dtype=tf.int32, shape=(1))
-        self.history_input = tf.placeholder(dtype=object, shape=(9, self.data_config._max_seq_len + 2))
+        writer.close()
+
+    def build_corpus_index(self):
+        """Builds the corpus code index of the trained checkpoint offline, so
+        that `retrieve_init` only has to memory-map it.
+        """
+        index_path = corpus_index_path(self.config._save_path, self.data_config.corpus_hparams['dataset']['files'])
+        corpus_iterator, utter_code = self.build_corpus_encoder()
+        with tf.Session(config=self.gpu_config) as sess:
+            sess.run(tf.tables_initializer())
+            saver = tf.train.Saver()
+            saver.restore(sess, self.config._save_path)
+            self.encode_corpus(sess, corpus_iterator, utter_code, index_path)
+        print('corpus index saved in {}'.format(index_path))
+
+    def retrieve_init(self, sess):
+        if self.mode != 'infer':
+            data_batch = self.iterator.get_next()
+            loss, acc, _ = self.forward(data_batch)
+        self.corpus = self.data_config._corpus
+        self.token_to_id = dict(self.vocab.token_to_id_map_py)
+        index_path = corpus_index_path(self.config._save_path, self.data_config.corpus_hparams['dataset']['files'])
+        if not os.path.exists(index_path):
+            corpus_iterator, utter_code = self.build_corpus_encoder()
+        self.build_retrieve_graph()
+        sess.run(tf.tables_initializer())
+        saver = tf.train.Saver()
+        saver.restore(sess, inference_checkpoint(self.config._save_path, self.mode, index_path))
+        if not os.path.exists(index_path):
+            self.encode_corpus(sess, corpus_iterator, utter_code, index_path)
+        self.index_path = index_path
+        self.corpus_code = load_corpus_index(index_path)
         self.keywords_embed = tf.nn.l2_normalize(self.embedder(self.kw_list), axis=1)
         self.kw_embedding = sess.run(self.keywords_embed)
+        weight, bias = sess.run(self.linear_matcher.trainable_variables)
+        self.retrieval_engine = build_retrieval_engine(self.index_path, self.corpus_code, weight, bias, self.data_config)
+
+    def reload_corpus(self):
+        """Swaps in the current content of the corpus files without rebuilding
+        the graph. Their corpus index must have been built beforehand with
+        `--mode build_index`.
+        """
+        corpus_files = self.data_config.corpus_hparams['dataset']['files']
+        index_path = corpus_index_path(self.config._save_path, corpus_files)
+        corpus = read_corpus(corpus_files)
+        corpus_code = load_corpus_index(index_path)
+        if len(corpus_code) != len(corpus):
+            raise ValueError('Corpus index {} holds {} codes for {} utterances.'.format(
+                index_path, len(corpus_code), len(corpus)))
+        retrieval_engine = build_retrieval_engine(index_path, corpus_code, self.retrieval_engine.weight,
+                                                  self.retrieval_engine.bias, self.data_config)
+        self.corpus = corpus
+        self.index_path, self.corpus_code, self.retrieval_engine = index_path, corpus_code, retrieval_engine
 
+    def build_retrieve_graph(self):
+        """Builds the ops `retrieve_batch` runs, which take the token ids built
+        by `utter_preprocess_ids` with `token_to_id`.
+        """
         # predict keyword
-        self.context_input = tf.placeholder(dtype=object)
-        context_ids = self.vocab.map_tokens_to_ids(self.context_input)
-        matching_score = self.forward_matrix(context_ids)
+        self.context_input = tf.placeholder(dtype=tf.int64, shape=(None, 20))
+        self.context_length_input = tf.placeholder(dtype=tf.int32, shape=(None,))
+        context_ids = self.context_input
+        matching_score = self.forward_matrix(context_ids, self.context_length_input)
         self.candi_output =tf.nn.top_k(matching_score, self.data_config._keywords_num)[1]
 
         # retrieve
-        self.minor_length_input = tf.placeholder(dtype=tf.int32, shape=(1, 9))
-        self.major_length_input = tf.placeholder(dtype=tf.int32, shape=(1))
-        self.history_input = tf.placeholder(dtype=object, shape=(9, self.data_config._max_seq_len + 2))
-        self.kw_input = tf.placeholder(dtype=tf.int32)
-        history_ids = self.vocab.map_tokens_to_ids(self.history_input)
+        self.minor_length_input = tf.placeholder(dtype=tf.int32, shape=(None, 9))
+        self.major_length_input = tf.placeholder(dtype=tf.int32, shape=(None,))
+        self.history_input = tf.placeholder(dtype=tf.int64, shape=(None, 9, self.data_config._max_seq_len + 2))
+        self.kw_input = tf.placeholder(dtype=tf.int32, shape=(None,))
+        history_ids = self.history_input
         history_embed = self.embedder(history_ids)
-        history_code = self.source_encoder(tf.expand_dims(history_embed, axis=0),
+        history_code = self.source_encoder(history_embed,
                                            sequence_length_minor=self.minor_length_input,
                                            sequence_length_major=self.major_length_input)[1]
-        self.next_kw_ids = self.kw_list[self.kw_input]
-        embed_code = tf.expand_dims(self.embedder(self.next_kw_ids), 0)
+        self.next_kw_ids = tf.gather(self.kw_list, self.kw_input)
+        embed_code = self.embedder(self.next_kw_ids)
         embed_code = self.linear_transform(embed_code)
-        history_code = tf.concat([history_code, embed_code], 1)
-        select_corpus = tf.cast(self.corpus_code, dtype=tf.float32)
-        feature_code = self.linear_matcher(select_corpus * history_code)
-        self.ans_output = tf.nn.top_k(tf.squeeze(feature_code,1), k=self.data_config._retrieval_candidates)[1]
+        self.history_code = tf.concat([history_code, embed_code], 1)
+        if self.mode == 'infer':
+            # the matcher is applied by the retrieval engine, this only creates its variables
+            self.linear_matcher(self.history_code)
+
+    def export(self):
+        """Exports the variables of the serving subgraph to a checkpoint next to
+        the training one, without the optimizer slots, the step counters and
+        the response encoders, which `retrieve_init` then restores in the
+        `infer` mode. Also builds the corpus index if needed, since it can't be
+        built from the exported checkpoint.
+        """
+        index_path = corpus_index_path(self.config._save_path, self.data_config.corpus_hparams['dataset']['files'])
+        self.build_retrieve_graph()
+        var_list = tf.global_variables()
+        with tf.Session(config=self.gpu_config) as sess:
+            print('inference checkpoint saved in {}'.format(export_checkpoint(sess, self.config._save_path, var_list)))
+        if not os.path.exists(index_path):
+            self.build_corpus_index()
+
+    def target_similarity(self, states):
+        """Returns the cosine similarities of shape `[len(states), num_keywords]`
+        between every keyword and the target of each of `states`.
+        """
+        targets = [self.data_config._keywords_dict[state.target] for state in states]
+        return np.dot(self.kw_embedding[targets], self.kw_embedding.T)
 
     def retrieve(self, history_all, sess):
-        history, seq_len, turns, context, context_len = history_all
-        kw_candi = sess.run(self.candi_output, feed_dict={self.context_input: context[:context_len]})
-        for kw in kw_candi:
-            tmp_score = sum(self.kw_embedding[kw] * self.kw_embedding[self.data_config._keywords_dict[self.target]])
-            if tmp_score > self.score:
-                self.score = tmp_score
-                self.next_kw = self.data_config._keywords_candi[kw]
-                break
-        ans = sess.run(self.ans_output, feed_dict={self.history_input: history,
-                                                   self.minor_length_input: [seq_len], self.major_length_input: [turns],
-                                                   self.kw_input: self.data_config._keywords_dict[self.next_kw]})
+        return self.retrieve_batch([history_all], [self], sess)[0]
+
+    def retrieve_batch(self, sources, states, sess):
+        """Retrieves one reply for each of `sources` with two `sess.run` calls
+        for the whole batch.
+
+        `states[i]` holds the conversation state of `sources[i]` (`target`,
+        `score`, `reply_list` and `next_kw`) and is updated in place.
+        """
+        timer = metrics.timer(**self.metric_labels)
+        history, seq_len, turns, context, context_len = zip(*sources)
+        kw_candi = sess.run(self.candi_output, feed_dict={self.context_input: context,
+                                                          self.context_length_input: context_len})
+        timer.lap('predict_keyword')
+        target_sims = self.target_similarity(states)
+        for state, candi, sims in zip(states, kw_candi, target_sims):
+            hits = np.flatnonzero(sims[candi] > state.score)
+            if len(hits):
+                state.score = sims[candi[hits[0]]]
+                state.next_kw = self.data_config._keywords_candi[candi[hits[0]]]
+        timer.lap('select_keyword')
+        history_code = sess.run(self.history_code, feed_dict={self.history_input: history,
+                                                              self.minor_length_input: seq_len, self.major_length_input: turns,
+                                                              self.kw_input: [self.data_config._keywords_dict[state.next_kw]
+                                                                              for state in states]})
+        timer.lap('encode_history')
+        ans = self.retrieval_engine.search(history_code, self.data_config._retrieval_candidates)
+        timer.lap('score_corpus')
+        replies = [self.select_reply(state, candidates) for state, candidates in zip(states, ans)]
+        timer.lap('rerank')
+        return replies
+
+    def select_reply(self, state, ans):
         for i in range(self.data_config._max_turns + 1):
-            if ans[i] not in self.reply_list:
-                self.reply_list.append(ans[i])
+            if ans[i] not in state.reply_list:
+                state.reply_list.append(ans[i])
                 reply = self.corpus[ans[i]]
                 break
         return reply
@@ -1,23 +1,39 @@
 import texar as tx
 import tensorflow as tf
 import numpy as np
-from preprocess.data_utils import kw_tokenize
+import os
+from preprocess.data_utils import kw_tokenize_batch
+from utils.corpus_index import corpus_index_path, read_corpus, load_corpus_index, CorpusIndexWriter, load_keyword_index
+from utils.ann_index import build_retrieval_engine
+from utils.vocab_utils import load_vocab, build_word_embedder
+from utils.dataset_cache import make_aligned_data
+from utils.eval_utils import StreamingEvaluator, KeywordMetrics, RankMetrics, format_metrics
+from utils.keyword_ops import keyword_labels, keyword_accuracy, keyword_token_ids
+from utils.checkpoint_utils import export_checkpoint, inference_checkpoint
+from utils.metrics_utils import metrics, agent_labels
 
 
 class Predictor():
     def __init__(self, config_model, config_data, mode=None):
         self.config = config_model
         self.data_config = config_data
+        self.metric_labels = agent_labels(__name__)
         self.gpu_config = tf.ConfigProto()
         self.gpu_config.gpu_options.allow_growth = True
-        self.build_model()
+        self.mode = mode
+        self.build_model(mode)
 
-    def build_model(self):
-        self.train_data = tx.data.MultiAlignedData(self.data_config.data_hparams['train'])
-        self.valid_data = tx.data.MultiAlignedData(self.data_config.data_hparams['valid'])
-        self.test_data = tx.data.MultiAlignedData(self.data_config.data_hparams['test'])
-        self.iterator = tx.data.TrainTestDataIterator(train=self.train_data, val=self.valid_data, test=self.test_data)
-        self.vocab = self.train_data.vocab(0)
+    def build_model(self, mode):
+        if mode == 'infer':
+            # serving restores the embeddings from the checkpoint and needs no datasets
+            self.train_data = None
+            self.vocab = load_vocab(self.data_config)
+        else:
+            self.train_data = make_aligned_data(self.data_config, 'train')
+            self.valid_data = make_aligned_data(self.data_config, 'valid')
+            self.test_data = make_aligned_data(self.data_config, 'test')
+            self.iterator = tx.data.TrainTestDataIterator(train=self.train_data, val=self.valid_data, test=self.test_data)
+            self.vocab = self.train_data.vocab(0)
         self.source_encoder = tx.modules.HierarchicalRNNEncoder(hparams=self.config.source_encoder_hparams)
         self.target_encoder = tx.modules.BidirectionalRNNEncoder(hparams=self.config.target_encoder_hparams)
         self.target_kwencoder = tx.modules.BidirectionalRNNEncoder(hparams=self.config.target_kwencoder_hparams)
@@ -25,7 +41,7 @@ class Predictor():
         self.linear_matcher = tx.modules.MLPTransformConnector(1)
         self.context_encoder = tx.modules.UnidirectionalRNNEncoder(hparams=self.config.context_encoder_hparams)
         self.predict_layer = tx.modules.MLPTransformConnector(self.data_config._keywords_num)
-        self.embedder = tx.modules.WordEmbedder(init_value=self.train_data.embedding_init_value(0).word_vecs)
+        self.embedder = build_word_embedder(self.data_config, self.vocab, self.train_data)
         self.kw_list = self.vocab.map_tokens_to_ids(tf.convert_to_tensor(self.data_config._keywords_candi))
         self.kw_vocab = tx.data.Vocab(self.data_config._keywords_path)
 
@@ -38,17 +54,13 @@ class Predictor():
     def predict_keywords(self, batch):
         matching_score = self.forward_neural(batch['context_text_ids'], batch['context_length'])
         keywords_ids = self.kw_vocab.map_tokens_to_ids(batch['keywords_text'])
-        kw_labels = tf.map_fn(lambda x: tf.sparse_to_dense(x, [self.kw_vocab.size], 1., 0., False),
-                              keywords_ids, dtype=tf.float32, parallel_iterations=True)[:, 4:]
+        kw_labels = keyword_labels(keywords_ids, self.kw_vocab.size)
         loss = tf.nn.sigmoid_cross_entropy_with_logits(labels=kw_labels, logits=matching_score)
         loss = tf.reduce_mean(loss)
         kw_ans = tf.arg_max(matching_score, -1)
-        acc_label = tf.map_fn(lambda x: tf.gather(x[0], x[1]), (kw_labels, kw_ans), dtype=tf.float32)
-        acc = tf.reduce_mean(acc_label)
+        acc = keyword_accuracy(kw_labels, kw_ans)
         kws = tf.nn.top_k(matching_score, k=5)[1]
-        kws = tf.reshape(kws,[-1])
-        kws = tf.map_fn(lambda x: self.kw_list[x], kws, dtype=tf.int64)
-        kws = tf.reshape(kws,[-1, 5])
+        kws = keyword_token_ids(self.kw_list, kws)
         return loss, acc, kws
 
     def train_keywords(self):
@@ -101,35 +113,19 @@ class Predictor():
             sess.run(tf.tables_initializer())
             saver.restore(sess, self.config._neural_save_path)
             self.iterator.switch_to_test_data(sess)
-            cnt_acc, cnt_rec1, cnt_rec3, cnt_rec5 = [], [], [], []
+            evaluator = StreamingEvaluator(KeywordMetrics())
             while True:
                 try:
                     feed = {tx.global_mode(): tf.estimator.ModeKeys.PREDICT}
-                    acc_, kw_ans, kw_labels = sess.run([acc, kws, batch['keywords_text_ids']], feed_dict=feed)
-                    cnt_acc.append(acc_)
-                    rec = [0,0,0,0,0]
-                    sum_kws = 0
-                    for i in range(len(kw_ans)):
-                        sum_kws += sum(kw_labels[i] > 3)
-                        for j in range(5):
-                            if kw_ans[i][j] in kw_labels[i]:
-                                for k in range(j, 5):
-                                    rec[k] += 1
-                    cnt_rec1.append(rec[0]/sum_kws)
-                    cnt_rec3.append(rec[2]/sum_kws)
-                    cnt_rec5.append(rec[4]/sum_kws)
-
+                    evaluator.add(*sess.run([acc, kws, batch['keywords_text_ids']], feed_dict=feed))
                 except tf.errors.OutOfRangeError:
-                    print('test_kw acc@1={:.4f}, rec@1={:.4f}, rec@3={:.4f}, rec@5={:.4f}'.format(
-                        np.mean(cnt_acc), np.mean(cnt_rec1), np.mean(cnt_rec3), np.mean(cnt_rec5)))
+                    print('test_kw ' + format_metrics(evaluator.result()))
                     break
 
     def forward(self, batch):
         matching_score = self.forward_neural(batch['context_text_ids'], batch['context_length'])
         kw_weight, predict_kw = tf.nn.top_k(matching_score, k=3)
-        predict_kw = tf.reshape(predict_kw, [-1])
-        predict_kw = tf.map_fn(lambda x: self.kw_list[x], predict_kw, dtype=tf.int64)
-        predict_kw = tf.reshape(predict_kw, [-1, 3])
+        predict_kw = keyword_token_ids(self.kw_list, predict_kw)
         embed_code = self.embedder(predict_kw)
         embed_code = tf.reduce_sum(embed_code, axis=1)
         embed_code = self.linear_transform(embed_code)
@@ -219,29 +215,17 @@ class Predictor():
             self.saver = tf.train.Saver()
             self.saver.restore(sess, self.config._save_path)
             self.iterator.switch_to_test_data(sess)
-            rank_cnt = []
+            evaluator = StreamingEvaluator(RankMetrics())
             while True:
                 try:
                     feed = {tx.global_mode(): tf.estimator.ModeKeys.PREDICT}
-                    ranks, labels = sess.run([rank, batch['label']], feed_dict=feed)
-                    for i in range(len(ranks)):
-                        rank_cnt.append(np.where(ranks[i]==labels[i])[0][0])
+                    evaluator.add(*sess.run([rank, batch['label']], feed_dict=feed))
                 except tf.errors.OutOfRangeError:
-                    rec = [0,0,0,0,0]
-                    MRR = 0
-                    for rank in rank_cnt:
-                        for i in range(5):
-                            rec[i] += (rank <= i)
-                        MRR += 1 / (rank+1)
-                    print('test rec1@20={:.4f}, rec3@20={:.4f}, rec5@20={:.4f}, MRR={:.4f}'.format(
-                        rec[0]/len(rank_cnt), rec[2]/len(rank_cnt), rec[4]/len(rank_cnt), MRR/len(rank_cnt)))
+                    print('test ' + format_metrics(evaluator.result()))
                     break
 
 
-    def retrieve_init(self, sess):
-        data_batch = self.iterator.get_next()
-        loss, acc, _ = self.forward(data_batch)
-        self.corpus = self.data_config._corpus
+    def build_corpus_encoder(self):
         self.corpus_data = tx.data.MonoTextData(self.data_config.corpus_hparams)
         corpus_iterator = tx.data.DataIterator(self.corpus_data)
         batch = corpus_iterator.get_next()
@@ -249,78 +233,170 @@ class Predictor():
         utter_code = self.target_encoder(corpus_embed, sequence_length=batch['corpus_length'])[1]
         utter_kwcode = self.target_kwencoder(corpus_embed, sequence_length=batch['corpus_length'])[1]
         utter_code = tf.concat([utter_code[0], utter_code[1], utter_kwcode[0], utter_kwcode[1]], -1)
-        self.corpus_code = np.zeros([0, self.config._code_len])
+        return corpus_iterator, utter_code
 
+    def encode_corpus(self, sess, corpus_iterator, utter_code, index_path):
+        """Encodes the whole corpus with the restored response encoders and
+        writes the codes to the corpus index at `index_path`.
+        """
         corpus_iterator.switch_to_dataset(sess)
-        sess.run(tf.tables_initializer())
-        saver = tf.train.Saver()
-        saver.restore(sess, self.config._save_path)
+        writer = CorpusIndexWriter(index_path, len(self.data_config._corpus), self.config._code_len)
         feed = {tx.global_mode(): tf.estimator.ModeKeys.PREDICT}
         while True:
             try:
-                utter_code_ = sess.run(utter_code, feed_dict=feed)
-                self.corpus_code = np.concatenate([self.corpus_code, utter_code_], axis=0)
+                writer.write(sess.run(utter_code, feed_dict=feed))
             except tf.errors.OutOfRangeError:
                 break
+        writer.close()
+
+    def build_corpus_index(self):
+        """Builds the corpus code index of the trained checkpoint offline, so
+        that `retrieve_init` only has to memory-map it.
+        """
+        index_path = corpus_index_path(self.config._save_path, self.data_config.corpus_hparams['dataset']['files'])
+        corpus_iterator, utter_code = self.build_corpus_encoder()
+        with tf.Session(config=self.gpu_config) as sess:
+            sess.run(tf.tables_initializer())
+            saver = tf.train.Saver()
+            saver.restore(sess, self.config._save_path)
+            self.encode_corpus(sess, corpus_iterator, utter_code, index_path)
+        print('corpus index saved in {}'.format(index_path))
+        load_keyword_index(self.data_config, kw_tokenize_batch)
+
+    def retrieve_init(self, sess):
+        if self.mode != 'infer':
+            data_batch = self.iterator.get_next()
+            loss, acc, _ = self.forward(data_batch)
+        self.corpus = self.data_config._corpus
+        self.token_to_id = dict(self.vocab.token_to_id_map_py)
+        index_path = corpus_index_path(self.config._save_path, self.data_config.corpus_hparams['dataset']['files'])
+        if not os.path.exists(index_path):
+            corpus_iterator, utter_code = self.build_corpus_encoder()
+        self.build_retrieve_graph()
+        sess.run(tf.tables_initializer())
+        saver = tf.train.Saver()
+        saver.restore(sess, inference_checkpoint(self.config._save_path, self.mode, index_path))
+        if not os.path.exists(index_path):
+            self.encode_corpus(sess, corpus_iterator, utter_code, index_path)
+        self.index_path = index_path
+        self.corpus_code = load_corpus_index(index_path)
+        self.corpus_keywords = load_keyword_index(self.data_config, kw_tokenize_batch)
         self.keywords_embed = tf.nn.l2_normalize(self.embedder(self.kw_list), axis=1)
         self.kw_embedding = sess.run(self.keywords_embed)
+        weight, bias = sess.run(self.linear_matcher.trainable_variables)
+        self.retrieval_engine = build_retrieval_engine(self.index_path, self.corpus_code, weight, bias, self.data_config)
+
+    def reload_corpus(self):
+        """Swaps in the current content of the corpus files without rebuilding
+        the graph. Their corpus index must have been built beforehand with
+        `--mode build_index`.
+        """
+        corpus_files = self.data_config.corpus_hparams['dataset']['files']
+        index_path = corpus_index_path(self.config._save_path, corpus_files)
+        corpus = read_corpus(corpus_files)
+        corpus_code = load_corpus_index(index_path)
+        if len(corpus_code) != len(corpus):
+            raise ValueError('Corpus index {} holds {} codes for {} utterances.'.format(
+                index_path, len(corpus_code), len(corpus)))
+        corpus_keywords = load_keyword_index(self.data_config, kw_tokenize_batch, corpus)
+        retrieval_engine = build_retrieval_engine(index_path, corpus_code, self.retrieval_engine.weight,
+                                                  self.retrieval_engine.bias, self.data_config)
+        self.corpus, self.corpus_keywords = corpus, corpus_keywords
+        self.index_path, self.corpus_code, self.retrieval_engine = index_path, corpus_code, retrieval_engine
 
+    def build_retrieve_graph(self):
+        """Builds the ops `retrieve_batch` runs, which take the token ids built
+        by `utter_preprocess_ids` with `token_to_id`.
+        """
         # predict keyword
-        self.context_input = tf.placeholder(dtype=object, shape=(20))
-        self.context_length_input = tf.placeholder(dtype=tf.int32, shape=(1))
-        context_ids = tf.expand_dims(self.vocab.map_tokens_to_ids(self.context_input), 0)
+        self.context_input = tf.placeholder(dtype=tf.int64, shape=(None, 20))
+        self.context_length_input = tf.placeholder(dtype=tf.int32, shape=(None,))
+        context_ids = self.context_input
         context_embed = self.embedder(context_ids)
         context_code = self.context_encoder(context_embed, sequence_length=self.context_length_input)[1]
         matching_score = self.predict_layer(context_code)
-        self.candi_output =tf.nn.top_k(tf.squeeze(matching_score, 0), self.data_config._keywords_num)[1]
+        self.candi_output =tf.nn.top_k(matching_score, self.data_config._keywords_num)[1]
 
         # retrieve
-        self.minor_length_input = tf.placeholder(dtype=tf.int32, shape=(1, 9))
-        self.major_length_input = tf.placeholder(dtype=tf.int32, shape=(1))
-        self.history_input = tf.placeholder(dtype=object, shape=(9, self.data_config._max_seq_len + 2))
-        self.kw_input = tf.placeholder(dtype=tf.int32)
-        history_ids = self.vocab.map_tokens_to_ids(self.history_input)
+        self.minor_length_input = tf.placeholder(dtype=tf.int32, shape=(None, 9))
+        self.major_length_input = tf.placeholder(dtype=tf.int32, shape=(None,))
+        self.history_input = tf.placeholder(dtype=tf.int64, shape=(None, 9, self.data_config._max_seq_len + 2))
+        self.kw_input = tf.placeholder(dtype=tf.int32, shape=(None,))
+        history_ids = self.history_input
         history_embed = self.embedder(history_ids)
-        history_code = self.source_encoder(tf.expand_dims(history_embed, axis=0),
+        history_code = self.source_encoder(history_embed,
                                            sequence_length_minor=self.minor_length_input,
                                            sequence_length_major=self.major_length_input)[1]
-        self.next_kw_ids = self.kw_list[self.kw_input]
-        embed_code = tf.expand_dims(self.embedder(self.next_kw_ids), 0)
+        self.next_kw_ids = tf.gather(self.kw_list, self.kw_input)
+        embed_code = self.embedder(self.next_kw_ids)
         embed_code = self.linear_transform(embed_code)
-        history_code = tf.concat([history_code, embed_code], 1)
-        select_corpus = tf.cast(self.corpus_code, dtype=tf.float32)
-        feature_code = self.linear_matcher(select_corpus * history_code)
-        self.ans_output = tf.nn.top_k(tf.squeeze(feature_code,1), k=self.data_config._retrieval_candidates)[1]
+        self.history_code = tf.concat([history_code, embed_code], 1)
+        if self.mode == 'infer':
+            # the matcher is applied by the retrieval engine, this only creates its variables
+            self.linear_matcher(self.history_code)
+
+    def export(self):
+        """Exports the variables of the serving subgraph to a checkpoint next to
+        the training one, without the optimizer slots, the step counters and
+        the response encoders, which `retrieve_init` then restores in the
+        `infer` mode. Also builds the corpus index if needed, since it can't be
+        built from the exported checkpoint.
+        """
+        index_path = corpus_index_path(self.config._save_path, self.data_config.corpus_hparams['dataset']['files'])
+        self.build_retrieve_graph()
+        var_list = tf.global_variables()
+        with tf.Session(config=self.gpu_config) as sess:
+            print('inference checkpoint saved in {}'.format(export_checkpoint(sess, self.config._save_path, var_list)))
+        if not os.path.exists(index_path):
+            self.build_corpus_index()
+
+    def target_similarity(self, states):
+        """Returns the cosine similarities of shape `[len(states), num_keywords]`
+        between every keyword and the target of each of `states`.
+        """
+        targets = [self.data_config._keywords_dict[state.target] for state in states]
+        return np.dot(self.kw_embedding[targets], self.kw_embedding.T)
 
     def retrieve(self, history_all, sess):
-        history, seq_len, turns, context, context_len = history_all
+        return self.retrieve_batch([history_all], [self], sess)[0]
+
+    def retrieve_batch(self, sources, states, sess):
+        """Retrieves one reply for each of `sources` with two `sess.run` calls
+        for the whole batch.
+
+        `states[i]` holds the conversation state of `sources[i]` (`target`,
+        `score`, `reply_list` and `next_kw`) and is updated in place.
+        """
+        timer = metrics.timer(**self.metric_labels)
+        history, seq_len, turns, context, context_len = zip(*sources)
         kw_candi = sess.run(self.candi_output, feed_dict={self.context_input: context,
-                                                          self.context_length_input: [context_len]})
-        for kw in kw_candi:
-            tmp_score = sum(self.kw_embedding[kw] * self.kw_embedding[self.data_config._keywords_dict[self.target]])
-            if tmp_score > self.score:
-                self.score = tmp_score
-                self.next_kw = self.data_config._keywords_candi[kw]
-                break
-        ans = sess.run(self.ans_output, feed_dict={self.history_input: history,
-                                                   self.minor_length_input: [seq_len], self.major_length_input: [turns],
-                                                   self.kw_input: self.data_config._keywords_dict[self.next_kw]})
-        flag = 0
+                                                          self.context_length_input: context_len})
+        timer.lap('predict_keyword')
+        target_sims = self.target_similarity(states)
+        for state, candi, sims in zip(states, kw_candi, target_sims):
+            hits = np.flatnonzero(sims[candi] > state.score)
+            if len(hits):
+                state.score = sims[candi[hits[0]]]
+                state.next_kw = self.data_config._keywords_candi[candi[hits[0]]]
+        timer.lap('select_keyword')
+        history_code = sess.run(self.history_code, feed_dict={self.history_input: history,
+                                                              self.minor_length_input: seq_len, self.major_length_input: turns,
+                                                              self.kw_input: [self.data_config._keywords_dict[state.next_kw]
+                                                                              for state in states]})
+        timer.lap('encode_history')
+        ans = self.retrieval_engine.search(history_code, self.data_config._retrieval_candidates)
+        timer.lap('score_corpus')
+        replies = [self.select_reply(state, candidates, sims)
+                   for state, candidates, sims in zip(states, ans, target_sims)]
+        timer.lap('rerank')
+        return replies
+
+    def select_reply(self, state, ans, target_sims):
         reply = self.corpus[ans[0]]
-        for i in ans:
-            if i in self.reply_list:  # avoid repeat
-                continue
-            for wd in kw_tokenize(self.corpus[i]):
-                if wd in self.data_config._keywords_candi:
-                    tmp_score = sum(self.kw_embedding[self.data_config._keywords_dict[wd]] *
-                                    self.kw_embedding[self.data_config._keywords_dict[self.target]])
-                    if tmp_score > self.score:
-                        reply = self.corpus[i]
-                        self.score = tmp_score
-                        self.next_kw = wd
-                        flag = 1
-                        break
-            if flag == 0:
-                continue
-            break
+        ans = ans[~np.isin(ans, state.reply_list)]  # avoid repeat
+        i, kw = self.corpus_keywords.first_hit(ans, target_sims > state.score)
+        if i is not None:
+            reply = self.corpus[i]
+            state.score = target_sims[kw]
+            state.next_kw = self.data_config._keywords_candi[kw]
         return reply
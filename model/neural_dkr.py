@@ -5,17 +5,27 @@ import numpy as np
 import os
 if os.environ['is_weibo'] == 'True':
     from preprocess_weibo.data_utils import pad
-    from preprocess_weibo.data_utils import kw_tokenize
+    from preprocess_weibo.data_utils import kw_tokenize_batch
 else:
     from preprocess.data_utils import pad
-    from preprocess.data_utils import kw_tokenize
+    from preprocess.data_utils import kw_tokenize_batch
 from utils.log_utils import create_logs, add_logs, add_log
+from utils.corpus_index import corpus_index_path, read_corpus, load_corpus_index, CorpusIndexWriter, load_keyword_index
+from utils.ann_index import build_retrieval_engine
+from utils.vocab_utils import load_vocab, build_word_embedder
+from utils.dataset_cache import make_aligned_data
+from utils.eval_utils import StreamingEvaluator, KeywordMetrics, RankMetrics, format_metrics
+from utils.keyword_ops import keyword_labels, keyword_accuracy, keyword_token_ids
+from utils.checkpoint_utils import export_checkpoint, inference_checkpoint
+from utils.keyword_graph import load_keyword_graphs
+from utils.metrics_utils import metrics, agent_labels
 
 
 class Predictor:
     def __init__(self, config_model, config_data, mode=None, kp_scope_name="pred_net", rr_scope_name="response_retrieval_net"):
         self.model_config = config_model
         self.data_config = config_data
+        self.metric_labels = agent_labels(__name__)
         self.gpu_config = tf.ConfigProto()
         self.gpu_config.gpu_options.allow_growth = True
         self.kp_scope_name = kp_scope_name
@@ -25,19 +35,25 @@ class Predictor:
         self.logs_save_path = self.model_config._log_save_path
         create_logs(self.logs_save_path)
 
-        self.build_data_iterator()
-        self.vocab = self.train_data.vocab(0)
+        self.mode = mode
+        self.build_data_iterator(mode)
 
         self.build_keyword_predictor_model()
         self.build_response_retrieval_model()
         # build keyword knowledge graph(adjacency matrix) for keyword mask generation
         self.build_keyword_kg()
 
-    def build_data_iterator(self):
-        self.train_data = tx.data.MultiAlignedData(self.data_config.data_hparams['train'])
-        self.valid_data = tx.data.MultiAlignedData(self.data_config.data_hparams['valid'])
-        self.test_data = tx.data.MultiAlignedData(self.data_config.data_hparams['test'])
+    def build_data_iterator(self, mode):
+        if mode == 'infer':
+            # serving restores the embeddings from the checkpoint and needs no datasets
+            self.train_data = None
+            self.vocab = load_vocab(self.data_config)
+            return
+        self.train_data = make_aligned_data(self.data_config, 'train')
+        self.valid_data = make_aligned_data(self.data_config, 'valid')
+        self.test_data = make_aligned_data(self.data_config, 'test')
         self.iterator = tx.data.TrainTestDataIterator(train=self.train_data, val=self.valid_data, test=self.test_data)
+        self.vocab = self.train_data.vocab(0)
 
     def build_keyword_predictor_model(self):
         with tf.variable_scope(name_or_scope=self.kp_scope_name, reuse=tf.AUTO_REUSE):
@@ -45,8 +61,8 @@ class Predictor:
             self.prev_predict_layer = tx.modules.MLPTransformConnector(2 * self.data_config._keywords_num,
                                                                        hparams={"activation_fn": "relu",})
             self.predict_layer = tx.modules.MLPTransformConnector(self.data_config._keywords_num)
-            self.embedder = tx.modules.WordEmbedder(init_value=self.train_data.embedding_init_value(0).word_vecs,
-                                                    hparams=self.model_config.embedder_hparams)
+            self.embedder = build_word_embedder(self.data_config, self.vocab, self.train_data,
+                                                hparams=self.model_config.embedder_hparams)
             self.kw_list = self.vocab.map_tokens_to_ids(tf.convert_to_tensor(self.data_config._keywords_candi))
             self.kw_vocab = tx.data.Vocab(self.data_config._keywords_path)
 
@@ -59,37 +75,6 @@ class Predictor:
             self.linear_matcher = tx.modules.MLPTransformConnector(1)
 
     def build_keyword_kg(self):
-        if os.environ['is_weibo'] == 'True':
-            with open("./tx_data_weibo/train/context.txt", "r") as f:
-                train_context_keywords_list = [x.strip().split() for x in f.readlines()]
-            with open("./tx_data_weibo/train/keywords.txt", "r") as f:
-                train_next_keywords_list = [x.strip().split() for x in f.readlines()]
-
-            with open("./tx_data_weibo/valid/context.txt", "r") as f:
-                valid_context_keywords_list = [x.strip().split() for x in f.readlines()]
-            with open("./tx_data_weibo/valid/keywords.txt", "r") as f:
-                valid_next_keywords_list = [x.strip().split() for x in f.readlines()]
-
-            with open("./tx_data_weibo/test/context.txt", "r") as f:
-                test_context_keywords_list = [x.strip().split() for x in f.readlines()]
-            with open("./tx_data_weibo/test/keywords.txt", "r") as f:
-                test_next_keywords_list = [x.strip().split() for x in f.readlines()]
-        else:
-            with open("./tx_data/train/context.txt", "r") as f:
-                train_context_keywords_list = [x.strip().split() for x in f.readlines()]
-            with open("./tx_data/train/keywords.txt", "r") as f:
-                train_next_keywords_list = [x.strip().split() for x in f.readlines()]
-
-            with open("./tx_data/valid/context.txt", "r") as f:
-                valid_context_keywords_list = [x.strip().split() for x in f.readlines()]
-            with open("./tx_data/valid/keywords.txt", "r") as f:
-                valid_next_keywords_list = [x.strip().split() for x in f.readlines()]
-
-            with open("./tx_data/test/context.txt", "r") as f:
-                test_context_keywords_list = [x.strip().split() for x in f.readlines()]
-            with open("./tx_data/test/keywords.txt", "r") as f:
-                test_next_keywords_list = [x.strip().split() for x in f.readlines()]
-
         # stoi_dict: dict mapping string(i.e. keyword) into adjacency matrix id
         # vocab_id_to_adj_matrix_id_dict: dict mapping vocab id into adjacency matrix id
         stoi_dict = {}
@@ -100,13 +85,6 @@ class Predictor:
         sorted_kw_vocab_items = sorted(self.kw_vocab.id_to_token_map_py.items(),key=lambda x:x[0])[4:]
         keywords_vocab_list.extend([item[1] for item in sorted_kw_vocab_items])
         self.adj_matrix_size = len(keywords_vocab_list)
-        self.train_kg_adjacency_matrix = np.zeros(shape=[self.adj_matrix_size, self.adj_matrix_size], dtype=np.float32)
-        self.valid_kg_adjacency_matrix = np.zeros(shape=[self.adj_matrix_size, self.adj_matrix_size], dtype=np.float32)
-        self.test_kg_adjacency_matrix = np.zeros(shape=[self.adj_matrix_size, self.adj_matrix_size], dtype=np.float32)
-        # add a large negative value to be easy to generate keyword mask
-        self.train_kg_adjacency_matrix += -1e8
-        self.valid_kg_adjacency_matrix += -1e8
-        self.test_kg_adjacency_matrix += -1e8
         for idx, keyword in enumerate(keywords_vocab_list):
             stoi_dict[keyword] = idx
             vocab_id_to_adj_matrix_id_dict[int(self.vocab.map_tokens_to_ids_py(keyword))] = idx
@@ -119,61 +97,46 @@ class Predictor:
             default_value=-1
         )
 
-        for context_keywords, next_keywords in zip(train_context_keywords_list, train_next_keywords_list):
-            for ckw in context_keywords:
-                ckw_idx = stoi_dict[ckw]
-                for nkw in next_keywords:
-                    nkw_idx = stoi_dict[nkw]
-                    self.train_kg_adjacency_matrix[ckw_idx][nkw_idx] = 1.
-
-        for context_keywords, next_keywords in zip(valid_context_keywords_list, valid_next_keywords_list):
-            for ckw in context_keywords:
-                ckw_idx = stoi_dict[ckw]
-                for nkw in next_keywords:
-                    nkw_idx = stoi_dict[nkw]
-                    self.valid_kg_adjacency_matrix[ckw_idx][nkw_idx] = 1.
-
-        for context_keywords, next_keywords in zip(test_context_keywords_list, test_next_keywords_list):
-            for ckw in context_keywords:
-                ckw_idx = stoi_dict[ckw]
-                for nkw in next_keywords:
-                    nkw_idx = stoi_dict[nkw]
-                    self.test_kg_adjacency_matrix[ckw_idx][nkw_idx] = 1.
-
-        self.train_kg_adjacency_matrix = tf.convert_to_tensor(self.train_kg_adjacency_matrix)
-        self.valid_kg_adjacency_matrix = tf.convert_to_tensor(self.valid_kg_adjacency_matrix)
-        self.test_kg_adjacency_matrix = tf.convert_to_tensor(self.test_kg_adjacency_matrix)
+        # sparse adjacency matrices, cached next to the data they are built from
+        graphs = load_keyword_graphs(self.data_config.data_root, self.data_config._keywords_path, stoi_dict)
+        self.train_kg_adjacency_matrix = self.sparse_adjacency_matrix(graphs['train'])
+        self.valid_kg_adjacency_matrix = self.sparse_adjacency_matrix(graphs['valid'])
+        self.test_kg_adjacency_matrix = self.sparse_adjacency_matrix(graphs['test'])
+
+    def sparse_adjacency_matrix(self, graph):
+        rows, cols = graph.edges()
+        return tf.SparseTensor(indices=np.stack([rows, cols], axis=1).astype(np.int64),
+                               values=tf.ones([len(graph)]),
+                               dense_shape=[self.adj_matrix_size, self.adj_matrix_size])
 
     def generate_keyword_mask(self, context_ids):
-        """Generate mask to only keep the related keywords' Q-value.
+        """Generate masks to only keep the related keywords' Q-value, for a
+        whole batch of contexts at once.
         """
-        self.kg_adjacency_matrix = tf.cond(pred=tf.equal(tx.global_mode(),tf.estimator.ModeKeys.TRAIN ),
-                                           true_fn=lambda: self.train_kg_adjacency_matrix,
-                                           false_fn=lambda: tf.cond(pred=tf.equal(tx.global_mode(),tf.estimator.ModeKeys.EVAL),
-                                                                    true_fn=lambda: self.valid_kg_adjacency_matrix,
-                                                                    false_fn=lambda: self.test_kg_adjacency_matrix))
-
         context_ids = tf.cast(context_ids, tf.int64)
-        # shape of adj_matrix_context_ids: [_cur_keywords_len,]
+        # shape of adj_matrix_context_ids: [batch_size, _cur_keywords_len]
+        # tokens out of the adjacency matrix (-1) get an all-zero one-hot row
         adj_matrix_context_ids = self.map_vocab_ids_to_adj_matrix_ids(context_ids)
-        # shape of context_related_adj_matrix: [#adj_matrix_context_ids, adj_matrix_size]
-        context_related_adj_matrix = tf.gather(self.kg_adjacency_matrix, adj_matrix_context_ids)
-        # shape of keyword_mask: [adj_matrix_size,]
-        keyword_mask = tf.reduce_max(context_related_adj_matrix, axis=0)
-
-        num_related_keywords = tf.reduce_sum(
-            tf.cast(
-                tf.equal(keyword_mask, 1.), tf.float32
-            )
-        )
-        no_related_keywords = tf.equal(num_related_keywords, 0.)
-        ones_tensor = tf.ones(shape=[self.adj_matrix_size])
-        # if no related keywords for current context, keep all keywords' Q-value
-        keyword_mask = tf.cond(pred=no_related_keywords,
-                               true_fn=lambda: ones_tensor,
-                               false_fn=lambda: keyword_mask)
+        # shape of context_multi_hot: [batch_size, adj_matrix_size]; the <PAD> keyword has no edge
+        context_multi_hot = tf.reduce_max(tf.one_hot(adj_matrix_context_ids, self.adj_matrix_size), axis=1)
+
+        def count_related_keywords(adjacency_matrix):
+            # (adjacency_matrix^T x context_multi_hot^T)^T, of shape [batch_size, adj_matrix_size]
+            return tf.transpose(tf.sparse_tensor_dense_matmul(adjacency_matrix, context_multi_hot,
+                                                              adjoint_a=True, adjoint_b=True))
+        num_related = tf.cond(pred=tf.equal(tx.global_mode(),tf.estimator.ModeKeys.TRAIN ),
+                              true_fn=lambda: count_related_keywords(self.train_kg_adjacency_matrix),
+                              false_fn=lambda: tf.cond(pred=tf.equal(tx.global_mode(),tf.estimator.ModeKeys.EVAL),
+                                                       true_fn=lambda: count_related_keywords(self.valid_kg_adjacency_matrix),
+                                                       false_fn=lambda: count_related_keywords(self.test_kg_adjacency_matrix)))
+        # a large negative value for the unrelated keywords
+        keyword_mask = tf.where(num_related > 0., tf.ones_like(num_related), tf.fill(tf.shape(num_related), -1e8))
+
+        no_related_keywords = tf.logical_not(tf.reduce_any(num_related > 0., axis=1))
+        # if no related keywords for a context, keep all keywords' Q-value
+        keyword_mask = tf.where(no_related_keywords, tf.ones_like(keyword_mask), keyword_mask)
         # remove the <PAD> dimension
-        keyword_mask = keyword_mask[1:]
+        keyword_mask = keyword_mask[:, 1:]
 
         return keyword_mask
 
@@ -198,7 +161,7 @@ class Predictor:
             keep_rate = tf.cond(tf.equal(tx.global_mode(), tf.estimator.ModeKeys.TRAIN), lambda: self.drop_rate, lambda:1.0)
             keyword_score = tf.nn.dropout(keyword_score, keep_rate)
             keyword_score = self.predict_layer(keyword_score)
-            keywords_mask = tf.map_fn(self.generate_keyword_mask, context_ids, dtype=tf.float32, parallel_iterations=True)
+            keywords_mask = self.generate_keyword_mask(context_ids)
             keyword_score = keyword_score - 1 + keywords_mask
             return keyword_score
 
@@ -206,18 +169,14 @@ class Predictor:
         predicted_keyword_score = self.forward_keyword_predictor(batch['context_text_ids'], batch['context_length'])
 
         label_keywords_ids = self.kw_vocab.map_tokens_to_ids(batch['keywords_text'])
-        kw_labels = tf.map_fn(lambda x: tf.sparse_to_dense(x, [self.kw_vocab.size], 1., 0., False),
-                              label_keywords_ids, dtype=tf.float32, parallel_iterations=True)[:, 4:]
+        kw_labels = keyword_labels(label_keywords_ids, self.kw_vocab.size)
 
         loss = tf.nn.sigmoid_cross_entropy_with_logits(labels=kw_labels, logits=predicted_keyword_score)
         loss = tf.reduce_mean(loss)
         kw_ans = tf.arg_max(predicted_keyword_score, -1)
-        acc_label = tf.map_fn(lambda x: tf.gather(x[0], x[1]), (kw_labels, kw_ans), dtype=tf.float32)
-        acc = tf.reduce_mean(acc_label)
+        acc = keyword_accuracy(kw_labels, kw_ans)
         kws = tf.nn.top_k(predicted_keyword_score, k=5)[1]
-        kws = tf.reshape(kws,[-1])
-        kws = tf.map_fn(lambda x: self.kw_list[x], kws, dtype=tf.int64)
-        kws = tf.reshape(kws,[-1, 5])
+        kws = keyword_token_ids(self.kw_list, kws)
         return loss, acc, kws
 
     def predict_keywords(self, batch):
@@ -275,37 +234,20 @@ class Predictor:
             sess.run(tf.tables_initializer())
             saver.restore(sess, self.model_config._kp_save_path)
             self.iterator.switch_to_test_data(sess)
-            cnt_acc, cnt_rec1, cnt_rec3, cnt_rec5 = [], [], [], []
+            evaluator = StreamingEvaluator(KeywordMetrics())
             while True:
                 try:
                     feed = {tx.global_mode(): tf.estimator.ModeKeys.PREDICT}
-                    acc_, kw_ans, kw_labels = sess.run([acc, kws, batch['keywords_text_ids']], feed_dict=feed)
-                    cnt_acc.append(acc_)
-                    rec = [0,0,0,0,0]
-                    sum_kws = 0
-                    for i in range(len(kw_ans)):
-                        sum_kws += sum(kw_labels[i] > 3)
-                        for j in range(5):
-                            if kw_ans[i][j] in kw_labels[i]:
-                                for k in range(j, 5):
-                                    rec[k] += 1
-                    cnt_rec1.append(rec[0]/sum_kws)
-                    cnt_rec3.append(rec[2]/sum_kws)
-                    cnt_rec5.append(rec[4]/sum_kws)
-
+                    evaluator.add(*sess.run([acc, kws, batch['keywords_text_ids']], feed_dict=feed))
                 except tf.errors.OutOfRangeError:
-                    logs_loss_acc = 'test_kw acc@1={:.4f}, rec@1={:.4f}, rec@3={:.4f}, rec@5={:.4f}'.format(
-                        np.mean(cnt_acc), np.mean(cnt_rec1), np.mean(cnt_rec3), np.mean(cnt_rec5))
-                    print(logs_loss_acc)
+                    print('test_kw ' + format_metrics(evaluator.result()))
                     break
 
     def forward_response_retrieval(self, batch):
         predicted_keyword_score = self.forward_keyword_predictor(batch['context_text_ids'], batch['context_length'])
 
         kw_weight, predict_kw = tf.nn.top_k(predicted_keyword_score, k=3)
-        predict_kw = tf.reshape(predict_kw, [-1])
-        predict_kw = tf.map_fn(lambda x: self.kw_list[x], predict_kw, dtype=tf.int64)
-        predict_kw = tf.reshape(predict_kw, [-1, 3])
+        predict_kw = keyword_token_ids(self.kw_list, predict_kw)
         with tf.variable_scope(name_or_scope=self.rr_scope_name, reuse=tf.AUTO_REUSE):
             embed_code = self.embedder(predict_kw)
             embed_code = tf.reduce_sum(embed_code, axis=1)
@@ -398,28 +340,16 @@ class Predictor:
             self.saver = tf.train.Saver()
             self.saver.restore(sess, self.model_config._retrieval_save_path)
             self.iterator.switch_to_test_data(sess)
-            rank_cnt = []
+            evaluator = StreamingEvaluator(RankMetrics())
             while True:
                 try:
                     feed = {tx.global_mode(): tf.estimator.ModeKeys.PREDICT}
-                    ranks, labels = sess.run([rank, batch['label']], feed_dict=feed)
-                    for i in range(len(ranks)):
-                        rank_cnt.append(np.where(ranks[i]==labels[i])[0][0])
+                    evaluator.add(*sess.run([rank, batch['label']], feed_dict=feed))
                 except tf.errors.OutOfRangeError:
-                    rec = [0,0,0,0,0]
-                    MRR = 0
-                    for rank in rank_cnt:
-                        for i in range(5):
-                            rec[i] += (rank <= i)
-                        MRR += 1 / (rank+1)
-                    print('test rec1@20={:.4f}, rec3@20={:.4f}, rec5@20={:.4f}, MRR={:.4f}'.format(
-                        rec[0]/len(rank_cnt), rec[2]/len(rank_cnt), rec[4]/len(rank_cnt), MRR/len(rank_cnt)))
+                    print('test ' + format_metrics(evaluator.result()))
                     break
 
-    def retrieve_init(self, sess):
-        data_batch = self.iterator.get_next()
-        loss, acc, _ = self.forward_response_retrieval(data_batch)
-        self.corpus = self.data_config._corpus
+    def build_corpus_encoder(self):
         self.corpus_data = tx.data.MonoTextData(self.data_config.corpus_hparams)
         corpus_iterator = tx.data.DataIterator(self.corpus_data)
         batch = corpus_iterator.get_next()
@@ -427,97 +357,180 @@ class Predictor:
         utter_code = self.target_encoder(corpus_embed, sequence_length=batch['corpus_length'])[1]
         utter_kwcode = self.target_kwencoder(corpus_embed, sequence_length=batch['corpus_length'])[1]
         utter_code = tf.concat([utter_code[0], utter_code[1], utter_kwcode[0], utter_kwcode[1]], -1)
-        self.corpus_code = np.zeros([0, self.model_config._code_len])
+        return corpus_iterator, utter_code
 
+    def encode_corpus(self, sess, corpus_iterator, utter_code, index_path):
+        """Encodes the whole corpus with the restored response encoders and
+        writes the codes to the corpus index at `index_path`.
+        """
         corpus_iterator.switch_to_dataset(sess)
-        sess.run(tf.tables_initializer())
-        saver = tf.train.Saver()
-        saver.restore(sess, self.model_config._retrieval_save_path)
+        writer = CorpusIndexWriter(index_path, len(self.data_config._corpus), self.model_config._code_len)
         feed = {tx.global_mode(): tf.estimator.ModeKeys.PREDICT}
         while True:
             try:
-                utter_code_ = sess.run(utter_code, feed_dict=feed)
-                self.corpus_code = np.concatenate([self.corpus_code, utter_code_], axis=0)
+                writer.write(sess.run(utter_code, feed_dict=feed))
             except tf.errors.OutOfRangeError:
                 break
-        self.keywords_embed = tf.nn.l2_normalize(self.embedder(self.kw_list), axis=1)
-        self.kw_embedding = sess.run(self.keywords_embed)
+        writer.close()
 
+    def build_corpus_index(self):
+        """Builds the corpus code index of the trained checkpoint offline, so
+        that `retrieve_init` only has to memory-map it.
+        """
+        index_path = corpus_index_path(self.model_config._retrieval_save_path, self.data_config.corpus_hparams['dataset']['files'])
+        corpus_iterator, utter_code = self.build_corpus_encoder()
+        with tf.Session(config=self.gpu_config) as sess:
+            sess.run(tf.tables_initializer())
+            saver = tf.train.Saver()
+            saver.restore(sess, self.model_config._retrieval_save_path)
+            self.encode_corpus(sess, corpus_iterator, utter_code, index_path)
+        print('corpus index saved in {}'.format(index_path))
+        load_keyword_index(self.data_config, kw_tokenize_batch)
+
+    def retrieve_init(self, sess):
+        if self.mode != 'infer':
+            data_batch = self.iterator.get_next()
+            loss, acc, _ = self.forward_response_retrieval(data_batch)
+        self.corpus = self.data_config._corpus
+        self.token_to_id = dict(self.vocab.token_to_id_map_py)
+        index_path = corpus_index_path(self.model_config._retrieval_save_path, self.data_config.corpus_hparams['dataset']['files'])
+        if not os.path.exists(index_path):
+            corpus_iterator, utter_code = self.build_corpus_encoder()
+        self.build_retrieve_graph()
+        sess.run(tf.tables_initializer())
+        saver = tf.train.Saver()
+        saver.restore(sess, inference_checkpoint(self.model_config._retrieval_save_path, self.mode, index_path))
+        if not os.path.exists(index_path):
+            self.encode_corpus(sess, corpus_iterator, utter_code, index_path)
+        self.index_path = index_path
+        self.corpus_code = load_corpus_index(index_path)
+        self.corpus_keywords = load_keyword_index(self.data_config, kw_tokenize_batch)
+        weight, bias = sess.run(self.linear_matcher.trainable_variables)
+        self.retrieval_engine = build_retrieval_engine(self.index_path, self.corpus_code, weight, bias, self.data_config)
+
+    def reload_corpus(self):
+        """Swaps in the current content of the corpus files without rebuilding
+        the graph. Their corpus index must have been built beforehand with
+        `--mode build_index`.
+        """
+        corpus_files = self.data_config.corpus_hparams['dataset']['files']
+        index_path = corpus_index_path(self.model_config._retrieval_save_path, corpus_files)
+        corpus = read_corpus(corpus_files)
+        corpus_code = load_corpus_index(index_path)
+        if len(corpus_code) != len(corpus):
+            raise ValueError('Corpus index {} holds {} codes for {} utterances.'.format(
+                index_path, len(corpus_code), len(corpus)))
+        corpus_keywords = load_keyword_index(self.data_config, kw_tokenize_batch, corpus)
+        retrieval_engine = build_retrieval_engine(index_path, corpus_code, self.retrieval_engine.weight,
+                                                  self.retrieval_engine.bias, self.data_config)
+        self.corpus, self.corpus_keywords = corpus, corpus_keywords
+        self.index_path, self.corpus_code, self.retrieval_engine = index_path, corpus_code, retrieval_engine
+
+    def build_retrieve_graph(self):
+        """Builds the ops `retrieve_batch` runs, which take the token ids built
+        by `utter_preprocess_ids` with `token_to_id`.
+        """
         # predict keyword
-        self.context_input = tf.placeholder(dtype=object, shape=(20))
-        self.context_length_input = tf.placeholder(dtype=tf.int32, shape=(1))
-        context_ids = tf.expand_dims(self.vocab.map_tokens_to_ids(self.context_input), 0)
+        self.context_input = tf.placeholder(dtype=tf.int64, shape=(None, 20))
+        self.context_length_input = tf.placeholder(dtype=tf.int32, shape=(None,))
+        context_ids = self.context_input
         context_embed = self.embedder(context_ids)
         context_code = self.context_encoder(context_embed, sequence_length=self.context_length_input)[1]
         keyword_score = self.prev_predict_layer(context_code)
         keyword_score = self.predict_layer(keyword_score)
-        keywords_mask = tf.map_fn(self.generate_keyword_mask, context_ids, dtype=tf.float32, parallel_iterations=True)
+        keywords_mask = self.generate_keyword_mask(context_ids)
         keyword_score = keyword_score - 1 + keywords_mask
-        self.candi_output =tf.nn.top_k(tf.squeeze(keyword_score, 0), self.data_config._keywords_num)[1]
+
+        # select keyword: the best scored keyword closer to the target than the
+        # current one, or the previous keyword if there is none
+        self.target_input = tf.placeholder(dtype=tf.int32, shape=(None,))
+        self.score_input = tf.placeholder(dtype=tf.float32, shape=(None,))
+        self.prev_kw_input = tf.placeholder(dtype=tf.int32, shape=(None,))
+        self.keywords_embed = tf.nn.l2_normalize(self.embedder(self.kw_list), axis=1)
+        self.target_sims = tf.matmul(tf.gather(self.keywords_embed, self.target_input), self.keywords_embed,
+                                     transpose_b=True)
+        accept = self.target_sims > tf.expand_dims(self.score_input, 1)
+        accepted_score = tf.where(accept, keyword_score, tf.fill(tf.shape(keyword_score), -np.inf))
+        self.kw_found = tf.reduce_any(accept, axis=1)
+        self.next_kw_output = tf.where(self.kw_found, tf.argmax(accepted_score, axis=1, output_type=tf.int32),
+                                       self.prev_kw_input)
 
         # retrieve
-        self.minor_length_input = tf.placeholder(dtype=tf.int32, shape=(1, 9))
-        self.major_length_input = tf.placeholder(dtype=tf.int32, shape=(1))
-        self.history_input = tf.placeholder(dtype=object, shape=(9, self.data_config._max_seq_len + 2))
-        self.kw_input = tf.placeholder(dtype=tf.int32)
-        history_ids = self.vocab.map_tokens_to_ids(self.history_input)
+        self.minor_length_input = tf.placeholder(dtype=tf.int32, shape=(None, 9))
+        self.major_length_input = tf.placeholder(dtype=tf.int32, shape=(None,))
+        self.history_input = tf.placeholder(dtype=tf.int64, shape=(None, 9, self.data_config._max_seq_len + 2))
+        history_ids = self.history_input
         history_embed = self.embedder(history_ids)
-        history_code = self.source_encoder(tf.expand_dims(history_embed, axis=0),
+        history_code = self.source_encoder(history_embed,
                                            sequence_length_minor=self.minor_length_input,
                                            sequence_length_major=self.major_length_input)[1]
-        self.next_kw_ids = self.kw_list[self.kw_input]
-        embed_code = tf.expand_dims(self.embedder(self.next_kw_ids), 0)
+        self.next_kw_ids = tf.gather(self.kw_list, self.next_kw_output)
+        embed_code = self.embedder(self.next_kw_ids)
         embed_code = self.linear_transform(embed_code)
-        history_code = tf.concat([history_code, embed_code], 1)
-        select_corpus = tf.cast(self.corpus_code, dtype=tf.float32)
-        feature_code = self.linear_matcher(select_corpus * history_code)
-        self.ans_output = tf.nn.top_k(tf.squeeze(feature_code,1), k=self.data_config._retrieval_candidates)[1]
+        self.history_code = tf.concat([history_code, embed_code], 1)
+        if self.mode == 'infer':
+            # the matcher is applied by the retrieval engine, this only creates its variables
+            self.linear_matcher(self.history_code)
+
+    def export(self):
+        """Exports the variables of the serving subgraph to a checkpoint next to
+        the training one, without the optimizer slots, the step counters and
+        the response encoders, which `retrieve_init` then restores in the
+        `infer` mode. Also builds the corpus index if needed, since it can't be
+        built from the exported checkpoint.
+        """
+        index_path = corpus_index_path(self.model_config._retrieval_save_path, self.data_config.corpus_hparams['dataset']['files'])
+        self.build_retrieve_graph()
+        var_list = tf.global_variables()
+        with tf.Session(config=self.gpu_config) as sess:
+            print('inference checkpoint saved in {}'.format(export_checkpoint(sess, self.model_config._retrieval_save_path, var_list)))
+        if not os.path.exists(index_path):
+            self.build_corpus_index()
 
     def retrieve(self, history_all, sess):
-        history, seq_len, turns, context, context_len = history_all
-        kw_candi = sess.run(self.candi_output, feed_dict={self.context_input: context,
-                                                          self.context_length_input: [context_len]})
-        for kw in kw_candi:
-            tmp_score = sum(self.kw_embedding[kw] * self.kw_embedding[self.data_config._keywords_dict[self.target]])
-            if tmp_score > self.score:
-                self.score = tmp_score
-                self.next_kw = self.data_config._keywords_candi[kw]
-                break
-        ans = sess.run(self.ans_output, feed_dict={self.history_input: history,
-                                                   self.minor_length_input: [seq_len], self.major_length_input: [turns],
-                                                   self.kw_input: self.data_config._keywords_dict[self.next_kw]})
-        flag = 0
+        return self.retrieve_batch([history_all], [self], sess)[0]
+
+    def retrieve_batch(self, sources, states, sess):
+        """Retrieves one reply for each of `sources` with a single `sess.run`
+        for the whole batch, which predicts and selects the next keywords and
+        encodes the histories.
+
+        `states[i]` holds the conversation state of `sources[i]` (`target`,
+        `score`, `reply_list` and `next_kw`) and is updated in place.
+        """
+        timer = metrics.timer(**self.metric_labels)
+        history, seq_len, turns, context, context_len = zip(*sources)
+        keywords_dict = self.data_config._keywords_dict
+        found, next_kw, target_sims, history_code = sess.run(
+            [self.kw_found, self.next_kw_output, self.target_sims, self.history_code],
+            feed_dict={self.context_input: context, self.context_length_input: context_len,
+                       self.history_input: history, self.minor_length_input: seq_len, self.major_length_input: turns,
+                       self.target_input: [keywords_dict[state.target] for state in states],
+                       self.score_input: [state.score for state in states],
+                       self.prev_kw_input: [keywords_dict.get(state.next_kw, 0) for state in states]})
+        for state, hit, kw, sims in zip(states, found, next_kw, target_sims):
+            if hit:
+                state.score = sims[kw]
+                state.next_kw = self.data_config._keywords_candi[kw]
+        timer.lap('encode_history')
+        ans = self.retrieval_engine.search(history_code, self.data_config._retrieval_candidates)
+        timer.lap('score_corpus')
+        replies = [self.select_reply(state, candidates, sims)
+                   for state, candidates, sims in zip(states, ans, target_sims)]
+        timer.lap('rerank')
+        return replies
+
+    def select_reply(self, state, ans, target_sims):
         reply = self.corpus[ans[0]]
-        for i in ans:
-            if i in self.reply_list:  # avoid repeat
-                continue
-            for wd in kw_tokenize(self.corpus[i]):
-                if wd in self.data_config._keywords_candi:
-                    tmp_score = sum(self.kw_embedding[self.data_config._keywords_dict[wd]] *
-                                    self.kw_embedding[self.data_config._keywords_dict[self.target]])
-                    # if tmp_score >= self.score:
-                    #     self.reply_list.append(i)
-                    #     reply = self.corpus[i]
-                    #     self.score = tmp_score
-                    #     self.next_kw = wd
-                    #     flag = 1
-                    #     break
-                    if tmp_score > self.score and self.score < 1.0:
-                        self.reply_list.append(i)
-                        reply = self.corpus[i]
-                        self.score = tmp_score
-                        self.refined_next_kw = wd
-                        flag = 1
-                        break
-                    else:
-                        if wd == self.target:
-                            self.reply_list.append(i)
-                            reply = self.corpus[i]
-                            self.score = tmp_score
-                            self.refined_next_kw = wd
-                            flag = 1
-                            break
-            if flag == 0:
-                continue
-            break
+        ans = ans[~np.isin(ans, state.reply_list)]  # avoid repeat
+        # a reply is accepted for its first keyword closer to the target than
+        # the current keyword, or for containing the target itself
+        accept = (target_sims > state.score) & (state.score < 1.0)
+        accept[self.data_config._keywords_dict[state.target]] = True
+        i, kw = self.corpus_keywords.first_hit(ans, accept)
+        if i is not None:
+            state.reply_list.append(i)
+            reply = self.corpus[i]
+            state.score = target_sims[kw]
+            state.refined_next_kw = self.data_config._keywords_candi[kw]
         return reply
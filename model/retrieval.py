@@ -1,23 +1,38 @@
 import texar as tx
 import tensorflow as tf
 import numpy as np
+import os
+from utils.corpus_index import corpus_index_path, read_corpus, load_corpus_index, CorpusIndexWriter
+from utils.ann_index import build_retrieval_engine
+from utils.vocab_utils import load_vocab, build_word_embedder
+from utils.dataset_cache import make_aligned_data
+from utils.eval_utils import StreamingEvaluator, RankMetrics, format_metrics
+from utils.checkpoint_utils import export_checkpoint, inference_checkpoint
+from utils.metrics_utils import metrics, agent_labels
 
 
 class Predictor():
     def __init__(self, config_model, config_data, mode=None):
         self.config = config_model
         self.data_config = config_data
-        self.build_model()
+        self.metric_labels = agent_labels(__name__)
+        self.mode = mode
+        self.build_model(mode)
         self.gpu_config = tf.ConfigProto()
         self.gpu_config.gpu_options.allow_growth = True
 
-    def build_model(self):
-        self.train_data = tx.data.MultiAlignedData(self.data_config.data_hparams['train'])
-        self.valid_data = tx.data.MultiAlignedData(self.data_config.data_hparams['valid'])
-        self.test_data = tx.data.MultiAlignedData(self.data_config.data_hparams['test'])
-        self.iterator = tx.data.TrainTestDataIterator(train=self.train_data, val=self.valid_data, test=self.test_data)
-        self.vocab = self.train_data.vocab(0)
-        self.embedder = tx.modules.WordEmbedder(init_value=self.train_data.embedding_init_value(0).word_vecs)
+    def build_model(self, mode):
+        if mode == 'infer':
+            # serving restores the embeddings from the checkpoint and needs no datasets
+            self.train_data = None
+            self.vocab = load_vocab(self.data_config)
+        else:
+            self.train_data = make_aligned_data(self.data_config, 'train')
+            self.valid_data = make_aligned_data(self.data_config, 'valid')
+            self.test_data = make_aligned_data(self.data_config, 'test')
+            self.iterator = tx.data.TrainTestDataIterator(train=self.train_data, val=self.valid_data, test=self.test_data)
+            self.vocab = self.train_data.vocab(0)
+        self.embedder = build_word_embedder(self.data_config, self.vocab, self.train_data)
         self.source_encoder = tx.modules.HierarchicalRNNEncoder(hparams=self.config.source_encoder_hparams)
         self.target_encoder = tx.modules.UnidirectionalRNNEncoder(hparams=self.config.target_encoder_hparams)
         self.linear_matcher = tx.modules.MLPTransformConnector(1)
@@ -94,67 +109,145 @@ class Predictor():
             self.saver = tf.train.Saver()
             self.saver.restore(sess, self.config._save_path)
             self.iterator.switch_to_test_data(sess)
-            rank_cnt = []
+            evaluator = StreamingEvaluator(RankMetrics())
             while True:
                 try:
                     feed = {tx.global_mode(): tf.estimator.ModeKeys.PREDICT}
-                    ranks, labels = sess.run([rank, batch['label']], feed_dict=feed)
-                    for i in range(len(ranks)):
-                        rank_cnt.append(np.where(ranks[i]==labels[i])[0][0])
+                    evaluator.add(*sess.run([rank, batch['label']], feed_dict=feed))
                 except tf.errors.OutOfRangeError:
-                    rec = [0,0,0,0,0]
-                    MRR = 0
-                    for rank in rank_cnt:
-                        for i in range(5):
-                            rec[i] += (rank <= i)
-                        MRR += 1 / (rank+1)
-                    print('test rec1@20={:.4f}, rec3@20={:.4f}, rec5@20={:.4f}, MRR={:.4f}'.format(
-                        rec[0]/len(rank_cnt), rec[2]/len(rank_cnt), rec[4]/len(rank_cnt), MRR/len(rank_cnt)))
+                    print('test ' + format_metrics(evaluator.result()))
                     break
 
-    def retrieve_init(self, sess):
-        data_batch = self.iterator.get_next()
-        loss, acc, _ = self.forward(data_batch)
-        self.corpus = self.data_config._corpus
+    def build_corpus_encoder(self):
         self.corpus_data = tx.data.MonoTextData(self.data_config.corpus_hparams)
         corpus_iterator = tx.data.DataIterator(self.corpus_data)
         batch = corpus_iterator.get_next()
         corpus_embed = self.embedder(batch['corpus_text_ids'])
         utter_code = self.target_encoder(corpus_embed, sequence_length=batch['corpus_length'])[1]
-        self.corpus_code = np.zeros([0, self.config._code_len])
+        return corpus_iterator, utter_code
+
+    def encode_corpus(self, sess, corpus_iterator, utter_code, index_path):
+        """Encodes the whole corpus with the restored response encoders and
+        writes the codes to the corpus index at `index_path`.
+        """
         corpus_iterator.switch_to_dataset(sess)
-        sess.run(tf.tables_initializer())
-        saver = tf.train.Saver()
-        saver.restore(sess, self.config._save_path)
+        writer = CorpusIndexWriter(index_path, len(self.data_config._corpus), self.config._code_len)
         feed = {tx.global_mode(): tf.estimator.ModeKeys.PREDICT}
         while True:
             try:
-                utter_code_ = sess.run(utter_code, feed_dict=feed)
-                self.corpus_code = np.concatenate([self.corpus_code, utter_code_], axis=0)
+                writer.write(sess.run(utter_code, feed_dict=feed))
             except tf.errors.OutOfRangeError:
                 break
+        writer.close()
 
-        self.minor_length_input = tf.placeholder(dtype=tf.int32, shape=(1, 9))
-        self.major_length_input = tf.placeholder(dtype=tf.int32, shape=(1))
-        self.history_input = tf.placeholder(dtype=object, shape=(9, self.data_config._max_seq_len + 2))
+    def build_corpus_index(self):
+        """Builds the corpus code index of the trained checkpoint offline, so
+        that `retrieve_init` only has to memory-map it.
+        """
+        index_path = corpus_index_path(self.config._save_path, self.data_config.corpus_hparams['dataset']['files'])
+        corpus_iterator, utter_code = self.build_corpus_encoder()
+        with tf.Session(config=self.gpu_config) as sess:
+            sess.run(tf.tables_initializer())
+            saver = tf.train.Saver()
+            saver.restore(sess, self.config._save_path)
+            self.encode_corpus(sess, corpus_iterator, utter_code, index_path)
+        print('corpus index saved in {}'.format(index_path))
 
-        history_ids = self.vocab.map_tokens_to_ids(self.history_input)
+    def retrieve_init(self, sess):
+        if self.mode != 'infer':
+            data_batch = self.iterator.get_next()
+            loss, acc, _ = self.forward(data_batch)
+        self.corpus = self.data_config._corpus
+        self.token_to_id = dict(self.vocab.token_to_id_map_py)
+        index_path = corpus_index_path(self.config._save_path, self.data_config.corpus_hparams['dataset']['files'])
+        if not os.path.exists(index_path):
+            corpus_iterator, utter_code = self.build_corpus_encoder()
+        self.build_retrieve_graph()
+        sess.run(tf.tables_initializer())
+        saver = tf.train.Saver()
+        saver.restore(sess, inference_checkpoint(self.config._save_path, self.mode, index_path))
+        if not os.path.exists(index_path):
+            self.encode_corpus(sess, corpus_iterator, utter_code, index_path)
+        self.index_path = index_path
+        self.corpus_code = load_corpus_index(index_path)
+        weight, bias = sess.run(self.linear_matcher.trainable_variables)
+        self.retrieval_engine = build_retrieval_engine(self.index_path, self.corpus_code, weight, bias, self.data_config)
+
+    def reload_corpus(self):
+        """Swaps in the current content of the corpus files without rebuilding
+        the graph. Their corpus index must have been built beforehand with
+        `--mode build_index`.
+        """
+        corpus_files = self.data_config.corpus_hparams['dataset']['files']
+        index_path = corpus_index_path(self.config._save_path, corpus_files)
+        corpus = read_corpus(corpus_files)
+        corpus_code = load_corpus_index(index_path)
+        if len(corpus_code) != len(corpus):
+            raise ValueError('Corpus index {} holds {} codes for {} utterances.'.format(
+                index_path, len(corpus_code), len(corpus)))
+        retrieval_engine = build_retrieval_engine(index_path, corpus_code, self.retrieval_engine.weight,
+                                                  self.retrieval_engine.bias, self.data_config)
+        self.corpus = corpus
+        self.index_path, self.corpus_code, self.retrieval_engine = index_path, corpus_code, retrieval_engine
+
+    def build_retrieve_graph(self):
+        """Builds the ops `retrieve_batch` runs, which take the token ids built
+        by `utter_preprocess_ids` with `token_to_id`.
+        """
+        self.minor_length_input = tf.placeholder(dtype=tf.int32, shape=(None, 9))
+        self.major_length_input = tf.placeholder(dtype=tf.int32, shape=(None,))
+        self.history_input = tf.placeholder(dtype=tf.int64, shape=(None, 9, self.data_config._max_seq_len + 2))
+
+        history_ids = self.history_input
         history_embed = self.embedder(history_ids)
-        history_code = self.source_encoder(tf.expand_dims(history_embed, axis=0),
-                                           sequence_length_minor=self.minor_length_input,
-                                           sequence_length_major=self.major_length_input)[1]
-        select_corpus = tf.cast(self.corpus_code, dtype=tf.float32)
-        feature_code = self.linear_matcher(select_corpus * history_code)
-        self.ans_output = tf.nn.top_k(tf.squeeze(feature_code, 1), k=self.data_config._retrieval_candidates)[1]
+        self.history_code = self.source_encoder(history_embed,
+                                                sequence_length_minor=self.minor_length_input,
+                                                sequence_length_major=self.major_length_input)[1]
+        if self.mode == 'infer':
+            # the matcher is applied by the retrieval engine, this only creates its variables
+            self.linear_matcher(self.history_code)
+
+    def export(self):
+        """Exports the variables of the serving subgraph to a checkpoint next to
+        the training one, without the optimizer slots, the step counters and
+        the response encoders, which `retrieve_init` then restores in the
+        `infer` mode. Also builds the corpus index if needed, since it can't be
+        built from the exported checkpoint.
+        """
+        index_path = corpus_index_path(self.config._save_path, self.data_config.corpus_hparams['dataset']['files'])
+        self.build_retrieve_graph()
+        var_list = tf.global_variables()
+        with tf.Session(config=self.gpu_config) as sess:
+            print('inference checkpoint saved in {}'.format(export_checkpoint(sess, self.config._save_path, var_list)))
+        if not os.path.exists(index_path):
+            self.build_corpus_index()
 
     def retrieve(self, source, sess):
-        history, seq_len, turns, context, context_len = source
-        ans = sess.run(self.ans_output, feed_dict={self.history_input: history,
-                                                   self.minor_length_input: [seq_len],
-                                                   self.major_length_input: [turns]})
+        return self.retrieve_batch([source], [self], sess)[0]
+
+    def retrieve_batch(self, sources, states, sess):
+        """Retrieves one reply for each of `sources` with one `sess.run` call
+        for the whole batch.
+
+        `states[i]` holds the conversation state of `sources[i]` (`reply_list`)
+        and is updated in place.
+        """
+        timer = metrics.timer(**self.metric_labels)
+        history, seq_len, turns, context, context_len = zip(*sources)
+        history_code = sess.run(self.history_code, feed_dict={self.history_input: history,
+                                                              self.minor_length_input: seq_len,
+                                                              self.major_length_input: turns})
+        timer.lap('encode_history')
+        ans = self.retrieval_engine.search(history_code, self.data_config._retrieval_candidates)
+        timer.lap('score_corpus')
+        replies = [self.select_reply(state, candidates) for state, candidates in zip(states, ans)]
+        timer.lap('rerank')
+        return replies
+
+    def select_reply(self, state, ans):
         for i in range(self.data_config._max_turns + 1):
-            if ans[i] not in self.reply_list:  # avoid repeat
-                self.reply_list.append(ans[i])
+            if ans[i] not in state.reply_list:  # avoid repeat
+                state.reply_list.append(ans[i])
                 reply = self.corpus[ans[i]]
                 break
         return reply
@@ -1,6 +1,12 @@
 import nltk
 import os
+import numpy as np
+import functools
+import hashlib
+import threading
+from collections import OrderedDict
 from nltk.stem import WordNetLemmatizer
+from nltk.tag.perceptron import PerceptronTagger
 
 _lemmatizer = WordNetLemmatizer()
 
@@ -12,11 +18,15 @@ def tokenize(example, ppln):
 
 
 def kw_tokenize(string):
-    return tokenize(string, [nltk_tokenize, lower, pos_tag, to_basic_form])
+    return keyword_tokenizer.kw_tokenize(string)
+
+
+def kw_tokenize_batch(strings):
+    return keyword_tokenizer.kw_tokenize_batch(strings)
 
 
 def simp_tokenize(string):
-    return tokenize(string, [nltk_tokenize, lower])
+    return keyword_tokenizer.simp_tokenize(string)
 
 
 def nltk_tokenize(string):
@@ -30,7 +40,7 @@ def lower(tokens):
 
 
 def pos_tag(tokens):
-    return nltk.pos_tag(tokens)
+    return keyword_tokenizer.tagger.tag(tokens)
 
 
 def to_basic_form(tokens):
@@ -45,7 +55,143 @@ def to_basic_form(tokens):
         pos = 'a'
     else:
         return word
-    return _lemmatizer.lemmatize(word, pos)
+    return keyword_tokenizer.lemmatize(word, pos)
+
+
+class _LRUCache:
+    def __init__(self, maxsize):
+        self.maxsize = maxsize
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            if key not in self._data:
+                return None
+            self._data.move_to_end(key)
+            return self._data[key]
+
+    def put(self, key, value):
+        with self._lock:
+            self._data[key] = value
+            self._data.move_to_end(key)
+            if len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+
+
+class KeywordTokenizer:
+    """Cached implementation of `simp_tokenize` and `kw_tokenize`.
+
+    `nltk.pos_tag` loads the tagger model at every call, so the tagger is
+    loaded once here. The lemmas of the vocabulary words are read from a
+    (word, POS) lexicon saved next to the vocabulary by `load_lexicon`, the
+    other lemmas and the tokens of whole utterances are memoized in bounded
+    LRU caches. The outputs are the same as those of the plain NLTK pipeline.
+
+    Args:
+        cache_size: Maximum number of utterances (and of lemmas out of the
+            lexicon) memoized per tokenization.
+    """
+    def __init__(self, cache_size=100000):
+        self._tagger = None
+        self.lexicon = {}
+        self._lemma_cache = _LRUCache(cache_size)
+        self._simp_cache = _LRUCache(cache_size)
+        self._kw_cache = _LRUCache(cache_size)
+
+    @property
+    def tagger(self):
+        if self._tagger is None:
+            self._tagger = PerceptronTagger()
+        return self._tagger
+
+    def load_lexicon(self, vocab_path):
+        """Loads the lexicon of the words of `vocab_path`, building and saving
+        it next to the vocabulary first if it does not exist yet.
+        """
+        path = lexicon_path(vocab_path)
+        if not os.path.exists(path):
+            with open(vocab_path, 'r') as f:
+                save_lexicon(build_lexicon(x.strip() for x in f.readlines()), path)
+        self.lexicon = load_lexicon(path)
+
+    def lemmatize(self, word, pos):
+        lemma = self.lexicon.get((word, pos))
+        if lemma is None:
+            lemma = self._lemma_cache.get((word, pos))
+        if lemma is None:
+            lemma = _lemmatizer.lemmatize(word, pos)
+            self._lemma_cache.put((word, pos), lemma)
+        return lemma
+
+    def simp_tokenize(self, string):
+        tokens = self._simp_cache.get(string)
+        if tokens is None:
+            tokens = tuple(lower(nltk_tokenize(string)))
+            self._simp_cache.put(string, tokens)
+        return list(tokens)
+
+    def kw_tokenize(self, string):
+        return self.kw_tokenize_batch([string])[0]
+
+    def simp_tokenize_batch(self, strings):
+        return [self.simp_tokenize(string) for string in strings]
+
+    def kw_tokenize_batch(self, strings):
+        """Tokenizes `strings`, tagging the ones that are not cached yet in one
+        call of the tagger.
+        """
+        tokens_list = [self._kw_cache.get(string) for string in strings]
+        missing = list(OrderedDict.fromkeys(string for string, tokens in zip(strings, tokens_list)
+                                            if tokens is None))
+        if missing:
+            tagged_list = self.tagger.tag_sents([self.simp_tokenize(string) for string in missing])
+            new_tokens = dict(zip(missing, [tuple(to_basic_form(tagged)) for tagged in tagged_list]))
+            for string, tokens in new_tokens.items():
+                self._kw_cache.put(string, tokens)
+            tokens_list = [new_tokens[string] if tokens is None else tokens
+                           for string, tokens in zip(strings, tokens_list)]
+        return [list(tokens) for tokens in tokens_list]
+
+
+_lexicon_pos = ['n', 'v', 'a']
+
+
+def lexicon_path(vocab_path):
+    """Returns the path of the lexicon of `vocab_path`, next to it and keyed
+    by its content.
+    """
+    with open(vocab_path, 'rb') as f:
+        sha = hashlib.sha1(f.read())
+    return '{}.lexicon_{}.txt'.format(vocab_path, sha.hexdigest()[:16])
+
+
+def build_lexicon(words):
+    """Returns a dict mapping `(word, pos)` to the lemma of each of `words`
+    for every POS of the lexicon.
+    """
+    return {(word, pos): _lemmatizer.lemmatize(word, pos) for word in words for pos in _lexicon_pos}
+
+
+def save_lexicon(lexicon, path):
+    words = OrderedDict.fromkeys(word for word, _ in lexicon)
+    tmp_path = path + '.tmp'
+    with open(tmp_path, 'w') as f:
+        for word in words:
+            f.write('\t'.join([word] + [lexicon[(word, pos)] for pos in _lexicon_pos]) + '\n')
+    os.replace(tmp_path, path)
+
+
+def load_lexicon(path):
+    lexicon = {}
+    with open(path, 'r') as f:
+        for line in f.readlines():
+            word, *lemmas = line.rstrip('\n').split('\t')
+            lexicon.update(((word, pos), lemma) for pos, lemma in zip(_lexicon_pos, lemmas))
+    return lexicon
+
+
+keyword_tokenizer = KeywordTokenizer()
 
 
 def truecasing(tokens):
@@ -69,10 +215,11 @@ def truecasing(tokens):
 
 candi_keyword_path = os.path.join(os.path.dirname(os.path.realpath(__file__)), 'convai2/candi_keyword.txt')
 _candiwords = [x.strip() for x in open(candi_keyword_path).readlines()]
+_candiword_set = set(_candiwords)
 
 
 def is_candiword(a):
-    if a in _candiwords:
+    if a in _candiword_set:
         return True
     return False
 
@@ -96,15 +243,48 @@ def calculate_linsim(a, b):
     return linsim
 
 
+goal_table_path = os.path.join(os.path.dirname(os.path.dirname(os.path.realpath(__file__))), 'tx_data/goal_linsim.txt')
+
+
+def build_goal_table(goals):
+    """Returns a dict mapping each of `goals` to the set of candidate words
+    whose Lin similarity with it is above 0.9.
+    """
+    return {goal: set(wd for wd in _candiwords if calculate_linsim(wd, goal) > 0.9) for goal in goals}
+
+
+def save_goal_table(goal_table, path):
+    with open(path, 'w') as f:
+        for goal, words in goal_table.items():
+            f.write('{}\t{}\n'.format(goal, ' '.join(sorted(words))))
+
+
+def load_goal_table(path):
+    goal_table = {}
+    for line in open(path).readlines():
+        goal, words = line.rstrip('\n').split('\t')
+        goal_table[goal] = set(words.split())
+    return goal_table
+
+
+# built offline by preprocess/prepare_goal_table.py
+_goal_table = load_goal_table(goal_table_path) if os.path.exists(goal_table_path) else {}
+
+
+@functools.lru_cache(maxsize=100000)
+def is_close_to_goal(wd, goal):
+    if goal in _goal_table:
+        return wd in _goal_table[goal]
+    return calculate_linsim(wd, goal) > 0.9
+
+
 def is_reach_goal(context, goal):
     context = kw_tokenize(context)
     if goal in context:
         return True
     for wd in context:
-        if is_candiword(wd):
-            rela = calculate_linsim(wd, goal)
-            if rela > 0.9:
-                return True
+        if is_candiword(wd) and is_close_to_goal(wd, goal):
+            return True
     return False
 
 
@@ -117,9 +297,17 @@ def make_context(string):
     return context
 
 
-def utter_preprocess(string_list, max_length):
+def utter_preprocess(string_list, max_length, tokens_list=None):
+    """`tokens_list` optionally holds the already tokenized (`simp_tokenize`)
+    utterances of `string_list`, so that a long-lived history is not
+    re-tokenized at every turn.
+    """
     source, minor_length = [], []
     string_list = string_list[-9:]
+    if tokens_list is None:
+        tokens_list = [simp_tokenize(string) for string in string_list]
+    else:
+        tokens_list = tokens_list[-9:]
     major_length = len(string_list)
     if major_length == 1:
         context = make_context(string_list[-1])
@@ -128,8 +316,7 @@ def utter_preprocess(string_list, max_length):
     context_len = len(context)
     while len(context) < 20:
         context.append('<PAD>')
-    for string in string_list:
-        string = simp_tokenize(string)
+    for string in tokens_list:
         if len(string) > max_length:
             string = string[:max_length]
         string = ['<BOS>'] + string + ['<EOS>']
@@ -142,6 +329,35 @@ def utter_preprocess(string_list, max_length):
         minor_length.append(0)
     return (source, minor_length, major_length, context, context_len)
 
+
+def utter_preprocess_ids(string_list, max_length, token_to_id, tokens_list=None):
+    """Same as `utter_preprocess`, but maps the tokens to their ids with the
+    `token_to_id` dict of the vocabulary and returns them as padded int64
+    arrays, which the serving graphs take without any in-graph lookup.
+    Contexts are truncated to 20 keywords.
+    """
+    string_list = string_list[-9:]
+    if tokens_list is None:
+        tokens_list = [simp_tokenize(string) for string in string_list]
+    else:
+        tokens_list = tokens_list[-9:]
+    major_length = len(string_list)
+    if major_length == 1:
+        context = make_context(string_list[-1])
+    else:
+        context = make_context(string_list[-2] + string_list[-1])
+    pad_id, bos_id, eos_id, unk_id = [token_to_id[token] for token in ['<PAD>', '<BOS>', '<EOS>', '<UNK>']]
+    context = [token_to_id.get(token, unk_id) for token in context[:20]]
+    context_ids = np.full(20, pad_id, dtype=np.int64)
+    context_ids[:len(context)] = context
+    source = np.full([9, max_length + 2], pad_id, dtype=np.int64)
+    minor_length = np.zeros(9, dtype=np.int32)
+    for i, tokens in enumerate(tokens_list):
+        ids = [bos_id] + [token_to_id.get(token, unk_id) for token in tokens[:max_length]] + [eos_id]
+        source[i, :len(ids)] = ids
+        minor_length[i] = len(ids)
+    return (source, minor_length, major_length, context_ids, len(context))
+
 def pad(sequence, padding_length):
     padded_sequence = sequence.copy()
     while len(padded_sequence) < padding_length:
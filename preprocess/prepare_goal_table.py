@@ -0,0 +1,11 @@
+from data_utils import build_goal_table, save_goal_table, goal_table_path
+from multiprocessing import Pool
+
+# the goals are the targets used in conversation and simulation
+goals = sorted(set(x.strip() for x in open('../tx_data/target_keywords_for_simulation.txt', 'r').readlines()))
+goal_table = {}
+with Pool() as pool:
+    for table in pool.imap_unordered(build_goal_table, [[goal] for goal in goals]):
+        goal_table.update(table)
+save_goal_table(goal_table, goal_table_path)
+print('{} goals saved in {}'.format(len(goal_table), goal_table_path))
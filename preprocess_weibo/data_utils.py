@@ -1,5 +1,6 @@
 import nltk
 import os
+import numpy as np
 from nltk.stem import WordNetLemmatizer
 
 import thulac
@@ -30,6 +31,9 @@ def split_words_seq_only(utter):
 def kw_tokenize(string):
     return string.split()
 
+def kw_tokenize_batch(strings):
+    return [string.split() for string in strings]
+
 #candi_keyword_path = os.path.join(os.path.dirname(os.path.realpath(__file__)), 'convai2/candi_keyword.txt')
 #_candiwords = [x.strip() for x in open(candi_keyword_path, encoding='UTF-8').readlines()]
 _candiwords = []
@@ -80,9 +84,24 @@ def make_context(string):
     return context
 
 
-def utter_preprocess(string_list, max_length):
+def simp_tokenize(string):
+    string = split_words_seq_only(string)
+    if isinstance(string, str):
+        string = string.split()
+    return string
+
+
+def utter_preprocess(string_list, max_length, tokens_list=None):
+    """`tokens_list` optionally holds the already tokenized (`simp_tokenize`)
+    utterances of `string_list`, so that a long-lived history is not
+    re-tokenized at every turn.
+    """
     source, minor_length = [], []
     string_list = string_list[-9:]
+    if tokens_list is None:
+        tokens_list = [simp_tokenize(string) for string in string_list]
+    else:
+        tokens_list = tokens_list[-9:]
     major_length = len(string_list)
     if major_length == 1:
         context = make_context(string_list[-1])
@@ -91,10 +110,7 @@ def utter_preprocess(string_list, max_length):
     context_len = len(context)
     while len(context) < 20:
         context.append('<PAD>')
-    for string in string_list:
-        string = split_words_seq_only(string)
-        if isinstance(string,str):
-            string = string.split()
+    for string in tokens_list:
         if len(string) > max_length:
             string = string[:max_length]
         string = ['<BOS>'] + string + ['<EOS>']
@@ -107,6 +123,35 @@ def utter_preprocess(string_list, max_length):
         minor_length.append(0)
     return (source, minor_length, major_length, context, context_len)
 
+
+def utter_preprocess_ids(string_list, max_length, token_to_id, tokens_list=None):
+    """Same as `utter_preprocess`, but maps the tokens to their ids with the
+    `token_to_id` dict of the vocabulary and returns them as padded int64
+    arrays, which the serving graphs take without any in-graph lookup.
+    Contexts are truncated to 20 keywords.
+    """
+    string_list = string_list[-9:]
+    if tokens_list is None:
+        tokens_list = [simp_tokenize(string) for string in string_list]
+    else:
+        tokens_list = tokens_list[-9:]
+    major_length = len(string_list)
+    if major_length == 1:
+        context = make_context(string_list[-1])
+    else:
+        context = make_context(string_list[-2] + string_list[-1])
+    pad_id, bos_id, eos_id, unk_id = [token_to_id[token] for token in ['<PAD>', '<BOS>', '<EOS>', '<UNK>']]
+    context = [token_to_id.get(token, unk_id) for token in context[:20]]
+    context_ids = np.full(20, pad_id, dtype=np.int64)
+    context_ids[:len(context)] = context
+    source = np.full([9, max_length + 2], pad_id, dtype=np.int64)
+    minor_length = np.zeros(9, dtype=np.int32)
+    for i, tokens in enumerate(tokens_list):
+        ids = [bos_id] + [token_to_id.get(token, unk_id) for token in tokens[:max_length]] + [eos_id]
+        source[i, :len(ids)] = ids
+        minor_length[i] = len(ids)
+    return (source, minor_length, major_length, context_ids, len(context))
+
 def pad(sequence, padding_length):
     padded_sequence = sequence.copy()
     while len(padded_sequence) < padding_length:
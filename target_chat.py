@@ -2,13 +2,13 @@ import tensorflow as tf
 import importlib
 import random
 import os
-from preprocess.data_utils import utter_preprocess, is_reach_goal
+from preprocess.data_utils import utter_preprocess_ids, is_reach_goal
 from utils.log_utils import create_logs, add_log
 import time
 
 class Target_Chat:
     def __init__(self, model, config_model, config_data):
-        self.agent = model.Predictor(config_model, config_data, 'test')
+        self.agent = model.Predictor(config_model, config_data, 'infer')
         self.sess = tf.Session(config=self.agent.gpu_config)
         self.agent.retrieve_init(self.sess)
 
@@ -30,7 +30,7 @@ class Target_Chat:
             add_log(self.conversation_save_path, 'START: {}'.format(reply))
         else:
             self.history.append(user_input)
-            source = utter_preprocess(self.history, self.agent.data_config._max_seq_len)
+            source = utter_preprocess_ids(self.history, self.agent.data_config._max_seq_len, self.agent.token_to_id)
             reply = self.agent.retrieve(source, self.sess)
             add_log(self.conversation_save_path, 'HUMAN: {}'.format(user_input), print_details=False)
             add_log(self.conversation_save_path, 'AGENT: {}'.format(reply))
@@ -74,7 +74,6 @@ def init_target_chat(agent_name, dataset):
     config_data = importlib.import_module(config_dir + 'data_config')
     config_model = importlib.import_module(config_dir + agent_name)
     model = importlib.import_module('model.' + agent_name)
-    predictor = model.Predictor(config_model, config_data, 'test')
 
     init_start_time = time.time()
     print("生成 TGODC-{}-{} Model 实例.................".format(agent_name, dataset))
@@ -2,66 +2,133 @@ import tensorflow as tf
 import importlib
 import random
 import os
-from preprocess.data_utils import utter_preprocess, is_reach_goal
+from preprocess.data_utils import utter_preprocess_ids, is_reach_goal, simp_tokenize, keyword_tokenizer
 from utils.log_utils import create_logs, add_log
+from utils.session_utils import ChatSession, SessionStore
+from utils.batch_utils import MicroBatchScheduler
+from utils.metrics_utils import metrics
 import time
+import threading
+from contextlib import contextmanager
 
 class Target_Chat:
-    def __init__(self, model, config_model, config_data):
+    def __init__(self, model, config_model, config_data, session_capacity=1000, session_ttl=1800,
+                 max_batch_size=32, max_wait=0.005, jsonl_logs=False):
         g = tf.Graph()
         with g.as_default():
-            self.agent = model.Predictor(config_model, config_data, 'test')
+            self.agent = model.Predictor(config_model, config_data, 'infer')
             self.sess = tf.Session(graph=g, config=self.agent.gpu_config)
             self.agent.retrieve_init(self.sess)
 
+        if os.environ['is_weibo'] == 'False':
+            keyword_tokenizer.load_lexicon(config_data._vocab_path)
         self.target_set = config_data._target_keywords_for_simulation
         self.start_corpus = config_data._start_corpus
         self.max_turns = config_data._max_turns
         self.conversation_save_path = config_model._conversation_save_path
-        self.current_sessions = 0
+        self.sessions = SessionStore(session_capacity, session_ttl)
+        # held by the retrievals, so that the corpus is never swapped in the middle of one
+        self.corpus_lock = threading.Lock()
+        # turns of concurrent sessions are retrieved together in one batch
+        self.scheduler = MicroBatchScheduler(self._retrieve_batch, max_batch_size, max_wait)
 
-        create_logs(self.conversation_save_path)
+        create_logs(self.conversation_save_path, jsonl=jsonl_logs)
 
-    def chat(self, user_history=[]):
+    def chat(self, session_id=None, user_input=None):
+        """Runs one turn of the conversation `session_id`.
+
+        A new conversation is started if `session_id` is unknown (or expired)
+        or `user_input` is empty. Returns the id of the session the turn was
+        served in and the responses of the agent.
+        """
+        session = self.sessions.get(session_id) if session_id else None
+        if session is None or not user_input:
+            session = self._new_session()
+            with session.lock:
+                return session.session_id, self._start(session)
+        with session.lock:
+            return session.session_id, self._reply(session, user_input)
+
+    def _start(self, session):
+        reply = session.start_utterance
+        add_log(self.conversation_save_path, '-------- Session {} --------'.format(session.session_id), print_details=False, session_id=session.session_id)
+        add_log(self.conversation_save_path, 'START: {}'.format(reply), print_details=False, session_id=session.session_id)
+        session.append(reply, simp_tokenize(reply))
+        session.current_turns += 1
+        return [reply]
+
+    def _reply(self, session, user_input):
+        timer = metrics.timer(**self.agent.metric_labels)
         responses = []
-        # if is the beginning of a conversation
-        if len(user_history) == 0:
-            self._reset()
-            reply = self.start_utterance
-            add_log(self.conversation_save_path, '-------- Session {} --------'.format(self.current_sessions), print_details=False)
-            add_log(self.conversation_save_path, 'START: {}'.format(reply), print_details=False)
-        else:
-            user_input = user_history[-1]
-            source = utter_preprocess(user_history, self.agent.data_config._max_seq_len)
-            reply = self.agent.retrieve(source, self.sess)
-            add_log(self.conversation_save_path, 'HUMAN: {}'.format(user_input), print_details=False)
-            add_log(self.conversation_save_path, 'AGENT: {}'.format(reply), print_details=False)
+        session.append(user_input, simp_tokenize(user_input))
+        source = utter_preprocess_ids(session.history, self.agent.data_config._max_seq_len, self.agent.token_to_id,
+                                      session.history_tokens)
+        timer.lap('preprocess')
+        reply = self.scheduler.submit((source, session))
+        timer.lap('retrieve')
+        add_log(self.conversation_save_path, '[{}] HUMAN: {}'.format(session.session_id, user_input), print_details=False, session_id=session.session_id)
+        add_log(self.conversation_save_path, '[{}] AGENT: {}'.format(session.session_id, reply), print_details=False, session_id=session.session_id)
+        timer.lap('log')
         responses.append(reply)
-        self.current_turns += 1
+        session.current_turns += 1
 
         # if the last two utterances contain target keyword
-        if is_reach_goal(' '.join(user_history[-2:]), self.target_keyword):
-            end_message = '[SUCCESS] target: \'{}\'.'.format(self.target_keyword)
-            add_log(self.conversation_save_path, end_message, print_details=False)
+        reach_goal = is_reach_goal(' '.join(session.history[-2:]), session.target)
+        timer.lap('goal_check')
+        if reach_goal:
+            end_message = '[SUCCESS] target: \'{}\'.'.format(session.target)
+            add_log(self.conversation_save_path, '[{}] {}'.format(session.session_id, end_message), print_details=False, session_id=session.session_id)
             responses.append(end_message)
         # if is out of the max dialogue turn
-        elif self.current_turns > self.max_turns:
-            end_message = '[FAIL] out of the max dialogue turns, target: \'{}\'.'.format(self.target_keyword)
-            add_log(self.conversation_save_path, end_message, print_details=False)
+        elif session.current_turns > self.max_turns:
+            end_message = '[FAIL] out of the max dialogue turns, target: \'{}\'.'.format(session.target)
+            add_log(self.conversation_save_path, '[{}] {}'.format(session.session_id, end_message), print_details=False, session_id=session.session_id)
             responses.append(end_message)
+        session.append(reply, simp_tokenize(reply))
 
+        if len(responses) > 1:
+            self.sessions.pop(session.session_id)
+        timer.total('turn')
         return responses
 
-    def _reset(self):
-        self.current_turns = 0
-        self.current_sessions += 1
-        self.start_utterance = random.sample(self.start_corpus, 1)[0]
-        self.target_keyword = random.sample(self.target_set,1)[0]
-        self.agent.target = self.target_keyword
-        self.agent.score = 0.
-        self.agent.reply_list = []
+    def warm_up(self):
+        """Runs one synthetic turn through the whole pipeline without logging
+        it, so that the lazy initialization of TensorFlow and of the caches
+        happens before the first user turn.
+        """
+        session = ChatSession(session_id='warm-up', target=self.target_set[0], start_utterance=self.start_corpus[0])
+        session.append(session.start_utterance, simp_tokenize(session.start_utterance))
+        source = utter_preprocess_ids(session.history, self.agent.data_config._max_seq_len, self.agent.token_to_id,
+                                      session.history_tokens)
+        reply = self.scheduler.submit((source, session))
+        session.append(reply, simp_tokenize(reply))
+        is_reach_goal(' '.join(session.history[-2:]), session.target)
+
+    def close(self):
+        self.scheduler.close()
+        self.sess.close()
+
+    def reload_corpus(self):
+        """Swaps in the current content of the corpus files (see
+        `Predictor.reload_corpus`). Turns wait for the swap to complete.
+        """
+        with self.corpus_lock:
+            self.agent.reload_corpus()
 
-def init_target_chat(agent_name, dataset):
+    def _retrieve_batch(self, items):
+        sources, sessions = zip(*items)
+        with self.corpus_lock:
+            return self.agent.retrieve_batch(list(sources), list(sessions), self.sess)
+
+    def _new_session(self):
+        session = ChatSession(session_id=self.sessions.new_session_id(),
+                              target=random.sample(self.target_set, 1)[0],
+                              start_utterance=random.sample(self.start_corpus, 1)[0])
+        self.sessions.put(session)
+        return session
+
+def init_target_chat(agent_name, dataset, session_capacity=1000, session_ttl=1800,
+                     max_batch_size=32, max_wait=0.005, jsonl_logs=False):
     # Target-Guided PersonaChat Dataset
     if dataset == 'TGPC':
         config_dir = 'config.'
@@ -74,13 +141,120 @@ def init_target_chat(agent_name, dataset):
     config_data = importlib.import_module(config_dir + 'data_config')
     config_model = importlib.import_module(config_dir + agent_name)
     model = importlib.import_module('model.' + agent_name)
-    predictor = model.Predictor(config_model, config_data, 'test')
 
     init_start_time = time.time()
     print("生成 TGODC-{}-{} Model 实例.................".format(agent_name, dataset))
-    target_chat_instance = Target_Chat(model, config_model, config_data)
+    target_chat_instance = Target_Chat(model, config_model, config_data, session_capacity, session_ttl,
+                                       max_batch_size, max_wait, jsonl_logs)
     print("TGODC-{}-{} Model 实例生成完成...............".format(agent_name, dataset))
     init_end_time = time.time()
     print('初始化花费时间: {:.2f}s'.format(init_end_time - init_start_time))
 
     return target_chat_instance
+
+
+class ModelRegistry:
+    """Loads a `Target_Chat` per (agent, dataset) on first use instead of at
+    import time, and unloads the ones that have been idle for `idle_timeout`
+    seconds.
+
+    Args:
+        idle_timeout: Seconds without turns after which a model is unloaded.
+            `None` keeps the models loaded.
+        **chat_kwargs: Arguments of `init_target_chat` besides the agent name
+            and the dataset.
+    """
+    def __init__(self, idle_timeout=None, **chat_kwargs):
+        self.idle_timeout = idle_timeout
+        self.chat_kwargs = chat_kwargs
+        self._models = {}
+        self._status = {}
+        self._in_use = {}
+        self._last_used = {}
+        # models are loaded one at a time, since `init_target_chat` selects the
+        # dataset through the `is_weibo` environment variable
+        self._load_lock = threading.Lock()
+        self._lock = threading.Lock()
+        if idle_timeout is not None:
+            threading.Thread(target=self._unload_idle_loop, daemon=True).start()
+
+    def get(self, agent_name, dataset):
+        """Returns the loaded `Target_Chat` of (agent_name, dataset), loading and
+        warming it up first if needed.
+        """
+        key = (agent_name, dataset)
+        with self._lock:
+            if key in self._models:
+                return self._models[key]
+        with self._load_lock:
+            with self._lock:
+                if key in self._models:
+                    return self._models[key]
+                self._status[key] = 'loading'
+            try:
+                target_chat = init_target_chat(agent_name, dataset, **self.chat_kwargs)
+                target_chat.warm_up()
+            except Exception:
+                with self._lock:
+                    self._status[key] = 'failed'
+                raise
+            with self._lock:
+                self._models[key] = target_chat
+                self._status[key] = 'ready'
+                self._last_used[key] = time.time()
+            return target_chat
+
+    def warm_up(self, agent_name, dataset):
+        self.get(agent_name, dataset)
+
+    @contextmanager
+    def use(self, agent_name, dataset):
+        """Context manager yielding the `Target_Chat` of (agent_name, dataset),
+        which is not unloaded while it is in use.
+        """
+        key = (agent_name, dataset)
+        while True:
+            target_chat = self.get(agent_name, dataset)
+            with self._lock:
+                # it may have been unloaded between `get` and here
+                if self._models.get(key) is target_chat:
+                    self._in_use[key] = self._in_use.get(key, 0) + 1
+                    break
+        try:
+            yield target_chat
+        finally:
+            with self._lock:
+                self._in_use[key] -= 1
+                self._last_used[key] = time.time()
+
+    def unload(self, agent_name, dataset):
+        key = (agent_name, dataset)
+        with self._lock:
+            if self._in_use.get(key, 0) > 0:
+                return False
+            target_chat = self._models.pop(key, None)
+            if target_chat is None:
+                return False
+            self._status[key] = 'unloaded'
+        target_chat.close()
+        return True
+
+    def unload_idle(self):
+        now = time.time()
+        with self._lock:
+            idle = [key for key in self._models
+                    if self._in_use.get(key, 0) == 0 and now - self._last_used[key] > self.idle_timeout]
+        for agent_name, dataset in idle:
+            self.unload(agent_name, dataset)
+
+    def _unload_idle_loop(self):
+        while True:
+            time.sleep(min(60, self.idle_timeout))
+            self.unload_idle()
+
+    def status(self):
+        """Returns `{(agent_name, dataset): 'loading' | 'ready' | 'failed' |
+        'unloaded'}` for every model requested so far.
+        """
+        with self._lock:
+            return dict(self._status)
@@ -3,7 +3,7 @@ import importlib
 import random
 import os
 from tqdm import tqdm
-from preprocess.data_utils import utter_preprocess, is_reach_goal
+from preprocess.data_utils import utter_preprocess_ids, is_reach_goal
 from model import retrieval
 from utils.log_utils import create_logs, add_logs, add_log
 
@@ -11,12 +11,12 @@ class Target_Simulation():
     def __init__(self, model, config_model, config_retrieval, config_data):
         g1 = tf.Graph()
         with g1.as_default():
-            self.agent = model.Predictor(config_model, config_data, 'test')
+            self.agent = model.Predictor(config_model, config_data, 'infer')
             self.agent_sess = tf.Session(graph=g1, config=self.agent.gpu_config)
             self.agent.retrieve_init(self.agent_sess)
         g2 = tf.Graph()
         with g2.as_default():
-            self.simulator = retrieval.Predictor(config_retrieval, config_data)
+            self.simulator = retrieval.Predictor(config_retrieval, config_data, 'infer')
             self.simulator_sess = tf.Session(graph=g2, config=self.simulator.gpu_config)
             self.simulator.retrieve_init(self.simulator_sess)
 
@@ -85,10 +85,10 @@ class Target_Simulation():
 
         simulation_outputs.append('START: {}'.format(start_utterance))
         for i in range(self.max_turns):
-            source = utter_preprocess(history, self.agent.data_config._max_seq_len)
+            source = utter_preprocess_ids(history, self.simulator.data_config._max_seq_len, self.simulator.token_to_id)
             simulator_reply = self.simulator.retrieve(source, self.simulator_sess)
             history.append(simulator_reply)
-            source = utter_preprocess(history, self.agent.data_config._max_seq_len)
+            source = utter_preprocess_ids(history, self.agent.data_config._max_seq_len, self.agent.token_to_id)
             agent_reply = self.agent.retrieve(source, self.agent_sess)
             simulation_outputs.append('SIMULATOR: {}'.format(simulator_reply))
             simulation_outputs.append('AGENT: {}'.format(agent_reply))
@@ -1,19 +1,30 @@
 from flask import Flask,  request, make_response
 import json
-from target_chat_for_server import init_target_chat
+from target_chat_for_server import ModelRegistry
+from utils.metrics_utils import metrics
 
-Chinese_target_chat_instance = init_target_chat('neural_dkr', 'CWC')  #初始化
-target_chat_instance = init_target_chat('neural_dkr', 'TGPC')  #初始化
-app = Flask(__name__)
+_session_capacity = 1000  # max live conversations per model
+_session_ttl = 1800  # seconds of inactivity before a conversation expires
+_max_batch_size = 32  # max concurrent turns retrieved in one batch
+_max_wait = 0.005  # seconds a turn waits for others to join its batch
+_jsonl_logs = False  # write the conversation logs as JSON lines, with the session id of each turn
+_idle_timeout = None  # seconds without turns before a model is unloaded, None keeps it loaded
+_models = [('neural_dkr', 'CWC'), ('neural_dkr', 'TGPC')]
 
+# models are loaded (and warmed up) on their first request, or by /warm_up
+registry = ModelRegistry(_idle_timeout, session_capacity=_session_capacity, session_ttl=_session_ttl,
+                         max_batch_size=_max_batch_size, max_wait=_max_wait, jsonl_logs=_jsonl_logs)
+app = Flask(__name__)
 
 
-@app.route('/Chinese_chatbot_api/', methods=["POST"])
-def Chinese_chatbot_api():
+def chat_response(agent_name, dataset):
+    # `sessionId` is returned by the first call of a conversation, `userIn` only
+    # carries the new utterance. A missing `userIn` starts a new conversation.
     data = {}
+    session_id = request.form.get('sessionId')
     user_input = request.form.get('userIn')
-    user_input_list = json.loads(user_input)
-    data['modelOut'] =Chinese_target_chat_instance.chat(user_input_list)
+    with registry.use(agent_name, dataset) as target_chat:
+        data['sessionId'], data['modelOut'] = target_chat.chat(session_id, user_input)
     data['state'] = "success"
     model_output = json.dumps(data)
     rst = make_response(model_output)
@@ -22,18 +33,40 @@ def Chinese_chatbot_api():
     return rst
 
 
+@app.route('/Chinese_chatbot_api/', methods=["POST"])
+def Chinese_chatbot_api():
+    return chat_response('neural_dkr', 'CWC')
+
 
 @app.route('/English_chatbot_api/', methods=["POST"])
 def English_chatbot_api():
-    data = {}
-    user_input = request.form.get('userIn')
-    user_input_list = json.loads(user_input)
-    data['modelOut'] =target_chat_instance.chat(user_input_list)
-    data['state'] = "success"
-    model_output = json.dumps(data)
-    rst = make_response(model_output)
-    rst.headers['Access-Control-Allow-Origin'] = '*'
-    rst.headers['Access-Control-Allow-Methods'] = 'POST'# 响应POST
+    return chat_response('neural_dkr', 'TGPC')
+
+
+@app.route('/warm_up', methods=["POST"])
+def warm_up_api():
+    # loads and warms up all the models, so that no user turn pays for it
+    for agent_name, dataset in _models:
+        registry.warm_up(agent_name, dataset)
+    return health_api()
+
+
+@app.route('/health', methods=["GET"])
+def health_api():
+    status = registry.status()
+    data = {'{}-{}'.format(agent_name, dataset): status.get((agent_name, dataset), 'unloaded')
+            for agent_name, dataset in _models}
+    rst = make_response(json.dumps(data))
+    rst.status_code = 200 if all(state == 'ready' for state in data.values()) else 503
+    rst.headers['Content-Type'] = 'application/json'
+    return rst
+
+
+@app.route('/metrics', methods=["GET"])
+def metrics_api():
+    # per-stage latency of chat turns, in the Prometheus text format
+    rst = make_response(metrics.render())
+    rst.headers['Content-Type'] = 'text/plain; version=0.0.4'
     return rst
 
 if __name__ == '__main__':
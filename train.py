@@ -8,7 +8,7 @@ if __name__ == '__main__':
     flags.DEFINE_string('dataset', 'TGPC', 'The dataset, supports TGPC / CWC.')
     flags.DEFINE_string('agent', 'neural_dkr', 'The agent type, \
         supports neural_dkr / kernel / matrix / neural / retrieval / retrieval_stgy.')
-    flags.DEFINE_string('mode', 'train_kw', 'The mode, supports train_kw / test_kw / train / test')
+    flags.DEFINE_string('mode', 'train_kw', 'The mode, supports train_kw / test_kw / train / test / build_index / export')
     FLAGS = flags.FLAGS
 
     # Target-Guided PersonaChat Dataset
@@ -25,7 +25,8 @@ if __name__ == '__main__':
     config_data = importlib.import_module(config_dir + 'data_config')
     config_model = importlib.import_module(config_dir + FLAGS.agent)
     model = importlib.import_module('model.' + FLAGS.agent)
-    predictor = model.Predictor(config_model, config_data, FLAGS.mode)
+    # the export only needs the serving subgraph
+    predictor = model.Predictor(config_model, config_data, 'infer' if FLAGS.mode == 'export' else FLAGS.mode)
     if not os.path.exists(save_dir + FLAGS.agent):
         os.makedirs(save_dir + FLAGS.agent)
 
@@ -39,3 +40,7 @@ if __name__ == '__main__':
         predictor.test()
     if FLAGS.mode == 'test':
         predictor.test()
+    if FLAGS.mode == 'build_index':
+        predictor.build_corpus_index()
+    if FLAGS.mode == 'export':
+        predictor.export()
@@ -0,0 +1,165 @@
+import os
+import numpy as np
+from utils.retrieval_engine import MIPSEngine, top_k
+
+
+def _nearest_centroid(x, centroids, chunk_size=8192):
+    """Returns the index of the nearest (L2) centroid of every row of `x`."""
+    sq_norm = (centroids * centroids).sum(1)
+    assign = np.empty(len(x), dtype=np.int64)
+    for start in range(0, len(x), chunk_size):
+        chunk = np.asarray(x[start: start + chunk_size], dtype=np.float32)
+        assign[start: start + chunk_size] = np.argmin(sq_norm - 2 * np.dot(chunk, centroids.T), axis=1)
+    return assign
+
+
+def kmeans(x, k, iters=20, rng=np.random):
+    """Lloyd's k-means on the rows of `x`. Returns centroids of shape
+    `[k, dim]`; an empty cluster keeps its previous centroid.
+    """
+    centroids = x[rng.choice(len(x), k, replace=False)].copy()
+    for _ in range(iters):
+        assign = _nearest_centroid(x, centroids)
+        order = np.argsort(assign, kind='stable')
+        counts = np.bincount(assign, minlength=k)
+        non_empty = np.nonzero(counts)[0]
+        starts = np.concatenate([[0], np.cumsum(counts)[:-1]])[non_empty]
+        sums = np.add.reduceat(x[order], starts, axis=0)
+        centroids[non_empty] = sums / counts[non_empty, None]
+    return centroids
+
+
+def ann_index_path(corpus_index_path, n_lists, subspace_dim):
+    """Returns the path of the IVF-PQ index built from the corpus index at
+    `corpus_index_path`, so that it is invalidated together with it.
+    """
+    return '{}.ivfpq_{}x{}.npz'.format(corpus_index_path[:-len('.npy')], n_lists, subspace_dim)
+
+
+class IVFPQIndex:
+    """Approximate maximum inner product search over the corpus codes.
+
+    The corpus is partitioned into `n_lists` k-means clusters (the inverted
+    file); the residual of every code to its cluster centroid is compressed by
+    product quantization to one byte per `subspace_dim` dimensions. A query is
+    only scored against the entries of the `nprobe` clusters whose centroids
+    have the largest inner product with it, using per-subspace lookup tables.
+    When the exact corpus codes are available, the best `rerank * k` entries
+    are re-scored exactly.
+
+    Use :meth:`train` to build an index and :meth:`load` to read a saved one.
+    The query side follows :class:`~utils.retrieval_engine.MIPSEngine`.
+    """
+    def __init__(self, centroids, codebooks, ids, offsets, codes, corpus_code, weight, bias, nprobe=32, rerank=4):
+        self.centroids = centroids
+        self.codebooks = codebooks
+        self.ids = ids
+        self.offsets = offsets
+        self.codes = codes
+        self.corpus_code = corpus_code
+        self.weight = np.asarray(weight, dtype=np.float32).reshape(-1)
+        self.bias = np.float32(np.asarray(bias).reshape(-1)[0])
+        self.nprobe = nprobe
+        self.rerank = rerank
+
+    def __len__(self):
+        return len(self.ids)
+
+    @classmethod
+    def train(cls, corpus_code, weight, bias, n_lists=1024, subspace_dim=8, train_size=100000, iters=20,
+              seed=0, **kwargs):
+        """Builds an index of `corpus_code` (`[corpus_size, code_len]`).
+
+        The clusters and the PQ codebooks are trained on a random sample of at
+        most `train_size` codes; `code_len` must be a multiple of
+        `subspace_dim`.
+        """
+        corpus_size, code_len = corpus_code.shape
+        if code_len % subspace_dim != 0:
+            raise ValueError('code_len {} is not a multiple of subspace_dim {}.'.format(code_len, subspace_dim))
+        n_subspaces = code_len // subspace_dim
+        rng = np.random.RandomState(seed)
+        sample_ids = np.sort(rng.choice(corpus_size, min(corpus_size, train_size), replace=False))
+        sample = np.asarray(corpus_code[sample_ids], dtype=np.float32)
+        n_lists = min(n_lists, len(sample))
+        n_centroids = min(256, len(sample))
+
+        centroids = kmeans(sample, n_lists, iters, rng)
+        residual = sample - centroids[_nearest_centroid(sample, centroids)]
+        residual = residual.reshape(len(sample), n_subspaces, subspace_dim)
+        codebooks = np.stack([kmeans(residual[:, j], n_centroids, iters, rng) for j in range(n_subspaces)])
+
+        assign = _nearest_centroid(corpus_code, centroids)
+        codes = np.empty([corpus_size, n_subspaces], dtype=np.uint8)
+        for start in range(0, corpus_size, 8192):
+            chunk = np.asarray(corpus_code[start: start + 8192], dtype=np.float32)
+            chunk = (chunk - centroids[assign[start: start + 8192]]).reshape(len(chunk), n_subspaces, subspace_dim)
+            for j in range(n_subspaces):
+                codes[start: start + 8192, j] = _nearest_centroid(chunk[:, j], codebooks[j])
+
+        ids = np.argsort(assign, kind='stable')
+        offsets = np.concatenate([[0], np.cumsum(np.bincount(assign, minlength=n_lists))])
+        return cls(centroids, codebooks, ids.astype(np.int32), offsets, codes[ids], corpus_code, weight, bias,
+                   **kwargs)
+
+    def save(self, path):
+        tmp_path = path[:-len('.npz')] + '.tmp.npz'
+        np.savez(tmp_path, centroids=self.centroids, codebooks=self.codebooks, ids=self.ids,
+                 offsets=self.offsets, codes=self.codes)
+        os.replace(tmp_path, path)
+
+    @classmethod
+    def load(cls, path, corpus_code, weight, bias, **kwargs):
+        with np.load(path) as index:
+            return cls(index['centroids'], index['codebooks'], index['ids'], index['offsets'], index['codes'],
+                       corpus_code, weight, bias, **kwargs)
+
+    def _search_one(self, query, coarse_score, k, nprobe):
+        sizes = self.offsets[1:] - self.offsets[:-1]
+        shortlist = min(k * self.rerank if self.corpus_code is not None else k, len(self))
+        lists = top_k(coarse_score, len(sizes))
+        # probe more lists than `nprobe` if they hold fewer than `shortlist` entries
+        n_lists = max(nprobe, np.searchsorted(np.cumsum(sizes[lists]), shortlist) + 1)
+        lists = lists[:n_lists]
+        ids = np.concatenate([self.ids[self.offsets[l]: self.offsets[l + 1]] for l in lists])
+        codes = np.concatenate([self.codes[self.offsets[l]: self.offsets[l + 1]] for l in lists])
+        table = np.einsum('jcd,jd->jc', self.codebooks, query.reshape(len(self.codebooks), -1))
+        scores = np.repeat(coarse_score[lists], sizes[lists]) + \
+            table[np.arange(len(table)), codes].sum(1)
+        candidates = ids[top_k(scores, shortlist)]
+        if self.corpus_code is None:
+            return candidates[:k]
+        exact_scores = np.dot(np.asarray(self.corpus_code[candidates], dtype=np.float32), query)
+        return candidates[top_k(exact_scores, k)]
+
+    def search(self, queries, k, nprobe=None):
+        """Returns the indices of shape `[batch_size, k]` of the (approximately)
+        best `k` corpus entries for each of `queries`, best first.
+        """
+        nprobe = nprobe or self.nprobe
+        queries = np.asarray(queries, dtype=np.float32) * self.weight
+        coarse_scores = np.dot(queries, self.centroids.T)
+        return np.stack([self._search_one(query, coarse_score, k, nprobe)
+                         for query, coarse_score in zip(queries, coarse_scores)])
+
+
+def load_ann_index(corpus_index_path, corpus_code, weight, bias, data_config):
+    """Loads the IVF-PQ index configured in `data_config` from next to the
+    corpus index, training and saving it first if it does not exist yet.
+    """
+    path = ann_index_path(corpus_index_path, data_config._ann_lists, data_config._ann_subspace_dim)
+    if os.path.exists(path):
+        return IVFPQIndex.load(path, corpus_code, weight, bias, nprobe=data_config._ann_nprobe)
+    index = IVFPQIndex.train(corpus_code, weight, bias, n_lists=data_config._ann_lists,
+                             subspace_dim=data_config._ann_subspace_dim, nprobe=data_config._ann_nprobe)
+    index.save(path)
+    return index
+
+
+def build_retrieval_engine(corpus_index_path, corpus_code, weight, bias, data_config):
+    """Returns the retrieval engine configured in `data_config`: the exact
+    :class:`~utils.retrieval_engine.MIPSEngine` or the :class:`IVFPQIndex`.
+    """
+    if data_config._ann_index:
+        return load_ann_index(corpus_index_path, corpus_code, weight, bias, data_config)
+    return MIPSEngine(corpus_code, weight, bias)
@@ -0,0 +1,87 @@
+import time
+import queue
+import threading
+
+
+class _Request:
+    def __init__(self, item):
+        self.item = item
+        self.result = None
+        self.error = None
+        self.done = threading.Event()
+
+
+class MicroBatchScheduler:
+    """Coalesces items submitted concurrently from many threads into batches.
+
+    A single worker thread waits for the first pending item, keeps collecting
+    items for at most `max_wait` seconds (or until `max_batch_size` items are
+    pending), then calls `batch_fn` once with the list of items and hands each
+    caller its own result.
+
+    Args:
+        batch_fn: Callable taking a list of items and returning a list of
+            results of the same length and order.
+        max_batch_size: Maximum number of items per call of `batch_fn`.
+        max_wait: Maximum seconds the first item of a batch waits for others.
+    """
+    def __init__(self, batch_fn, max_batch_size=32, max_wait=0.005):
+        self.batch_fn = batch_fn
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait
+        self._queue = queue.Queue()
+        self._worker = threading.Thread(target=self._run, daemon=True)
+        self._worker.start()
+
+    def close(self):
+        """Stops the worker thread once the pending items are processed."""
+        self._queue.put(None)
+        self._worker.join()
+
+    def submit(self, item):
+        """Blocks until `item` has been processed and returns its result.
+
+        Exceptions raised by `batch_fn` are re-raised in every caller of the
+        failed batch.
+        """
+        request = _Request(item)
+        self._queue.put(request)
+        request.done.wait()
+        if request.error is not None:
+            raise request.error
+        return request.result
+
+    def _next_batch(self):
+        batch = [self._queue.get()]
+        deadline = time.time() + self.max_wait
+        while len(batch) < self.max_batch_size and batch[-1] is not None:
+            timeout = deadline - time.time()
+            if timeout <= 0:
+                break
+            try:
+                batch.append(self._queue.get(timeout=timeout))
+            except queue.Empty:
+                break
+        return batch
+
+    def _run(self):
+        while True:
+            batch = self._next_batch()
+            closed = batch[-1] is None
+            if closed:
+                batch.pop()
+            if batch:
+                self._run_batch(batch)
+            if closed:
+                break
+
+    def _run_batch(self, batch):
+        try:
+            results = self.batch_fn([request.item for request in batch])
+            for request, result in zip(batch, results):
+                request.result = result
+        except Exception as e:
+            for request in batch:
+                request.error = e
+        for request in batch:
+            request.done.set()
@@ -0,0 +1,57 @@
+import os
+import hashlib
+import tensorflow as tf
+from utils.corpus_index import _update_hash
+
+
+def export_path(save_path):
+    """Returns the path of the inference checkpoint exported from the training
+    checkpoint at `save_path`, keyed by the content of its `.index` file like
+    the corpus index, so that an export of another checkpoint is never used.
+    """
+    sha = hashlib.sha1()
+    _update_hash(sha, save_path + '.index')
+    return '{}.infer_{}'.format(save_path, sha.hexdigest()[:16])
+
+
+def export_checkpoint(sess, save_path, var_list):
+    """Restores `var_list` from the training checkpoint at `save_path` and
+    saves only them, without the meta graph, to `export_path(save_path)`.
+    """
+    saver = tf.train.Saver(var_list)
+    saver.restore(sess, save_path)
+    saver.save(sess, export_path(save_path), write_meta_graph=False)
+    return export_path(save_path)
+
+
+def inference_checkpoint(save_path, mode, index_path):
+    """Returns the checkpoint `retrieve_init` restores: the exported one when
+    it exists and only the serving subgraph is built (`mode == 'infer'` and
+    the corpus index at `index_path` exists, so that the response encoders
+    are not needed), otherwise the training checkpoint.
+    """
+    if mode == 'infer' and os.path.exists(index_path) and tf.train.checkpoint_exists(export_path(save_path)):
+        return export_path(save_path)
+    return save_path
+
+
+if __name__ == '__main__':
+    # checks that an export is not used once the training checkpoint changes
+    import tempfile
+    with tempfile.TemporaryDirectory() as save_dir:
+        save_path = os.path.join(save_dir, 'model')
+        index_path = save_path + '.corpus.npy'
+        open(index_path, 'w').close()
+        weight = tf.Variable(1., name='weight')
+        saver = tf.train.Saver([weight])
+        with tf.Session() as sess:
+            sess.run(weight.initializer)
+            saver.save(sess, save_path, write_meta_graph=False)
+            exported = export_checkpoint(sess, save_path, [weight])
+            assert inference_checkpoint(save_path, 'infer', index_path) == exported
+            assert inference_checkpoint(save_path, 'train', index_path) == save_path
+            # retrains
+            sess.run(weight.assign(2.))
+            saver.save(sess, save_path, write_meta_graph=False)
+            assert inference_checkpoint(save_path, 'infer', index_path) == save_path
+    print('ok')
@@ -0,0 +1,164 @@
+import os
+import glob
+import hashlib
+import numpy as np
+
+
+def _update_hash(sha, path, chunk_size=1 << 20):
+    with open(path, 'rb') as f:
+        while True:
+            chunk = f.read(chunk_size)
+            if not chunk:
+                break
+            sha.update(chunk)
+
+
+def corpus_index_path(checkpoint_path, corpus_files):
+    """Returns the path of the corpus code index of `checkpoint_path`.
+
+    The path is keyed by the content of the checkpoint (its `.index` file,
+    which carries the checksums of all saved tensors) and of the corpus
+    files, so that any change of either points to a new index.
+    """
+    sha = hashlib.sha1()
+    _update_hash(sha, checkpoint_path + '.index')
+    for corpus_file in corpus_files:
+        _update_hash(sha, corpus_file)
+    return '{}.corpus_{}.npy'.format(checkpoint_path, sha.hexdigest()[:16])
+
+
+def read_corpus(corpus_files):
+    """Returns the utterances of `corpus_files`, one per line."""
+    corpus = []
+    for corpus_file in corpus_files:
+        with open(corpus_file, 'r') as f:
+            corpus.extend(x.strip() for x in f.readlines())
+    return corpus
+
+
+def load_corpus_index(index_path):
+    """Memory-maps a corpus code index as a read-only float32 array of shape
+    `[corpus_size, code_len]`.
+    """
+    return np.load(index_path, mmap_mode='r')
+
+
+class CorpusIndexWriter:
+    """Writes corpus codes batch by batch into a preallocated `.npy` file.
+
+    The file is written under a temporary name and moved to `index_path` on
+    `close`, so that an interrupted build never leaves a truncated index
+    behind. Indexes of the same checkpoint with another key, and the files
+    derived from them, are removed.
+    """
+    def __init__(self, index_path, corpus_size, code_len):
+        self.index_path = index_path
+        self.tmp_path = index_path + '.tmp.npy'
+        self.codes = np.lib.format.open_memmap(self.tmp_path, mode='w+', dtype=np.float32,
+                                               shape=(corpus_size, code_len))
+        self.size = 0
+
+    def write(self, codes):
+        self.codes[self.size: self.size + len(codes)] = codes
+        self.size += len(codes)
+
+    def close(self):
+        if self.size != len(self.codes):
+            raise ValueError('Corpus index {} expects {} codes, got {}.'.format(
+                self.index_path, len(self.codes), self.size))
+        self.codes.flush()
+        del self.codes
+        prefix = self.index_path[:self.index_path.rindex('.corpus_')]
+        key = self.index_path[:-len('.npy')]
+        for stale_path in glob.glob(prefix + '.corpus_*'):
+            if stale_path != self.index_path and not stale_path.startswith(key + '.'):
+                os.remove(stale_path)
+        os.replace(self.tmp_path, self.index_path)
+
+
+def keyword_index_path(corpus_files, keywords_path, tokenize_batch):
+    """Returns the path of the corpus keyword index, next to the first corpus
+    file and keyed by the corpus, the keyword vocabulary and the tokenizer.
+    """
+    sha = hashlib.sha1()
+    for path in list(corpus_files) + [keywords_path]:
+        _update_hash(sha, path)
+    sha.update('{}.{}'.format(tokenize_batch.__module__, tokenize_batch.__name__).encode())
+    return '{}.keywords_{}.npz'.format(corpus_files[0], sha.hexdigest()[:16])
+
+
+class CorpusKeywordIndex:
+    """Maps every corpus utterance to the ids of the candidate keywords it
+    contains, in order of first occurrence, as CSR arrays.
+
+    `index[i]` is the keyword id array of the `i`-th utterance.
+    """
+    def __init__(self, indptr, indices):
+        self.indptr = indptr
+        self.indices = indices
+
+    def __len__(self):
+        return len(self.indptr) - 1
+
+    def __getitem__(self, i):
+        return self.indices[self.indptr[i]: self.indptr[i + 1]]
+
+    def first_hit(self, rows, accept):
+        """Returns `(row, keyword_id)` for the first keyword id `kw` with
+        `accept[kw]` over the keywords of `rows`, scanned row by row, or
+        `(None, None)` if there is none.
+
+        Args:
+            rows: Array of utterance indexes, in scan order.
+            accept: Boolean array of shape `[num_keywords]`.
+        """
+        rows = np.asarray(rows, dtype=np.int64)
+        lengths = self.indptr[rows + 1] - self.indptr[rows]
+        offsets = np.cumsum(lengths)
+        positions = np.repeat(self.indptr[rows] - (offsets - lengths), lengths) + np.arange(lengths.sum())
+        keywords = self.indices[positions]
+        hits = np.flatnonzero(accept[keywords])
+        if len(hits) == 0:
+            return None, None
+        return rows[np.searchsorted(offsets, hits[0], side='right')], keywords[hits[0]]
+
+    @classmethod
+    def build(cls, corpus, keywords_dict, tokenize_batch, chunk_size=10000):
+        """Builds the index of `corpus`, tokenized `chunk_size` utterances at
+        a time by `tokenize_batch`, which maps a list of utterances to the
+        list of their tokens.
+        """
+        indptr = np.zeros(len(corpus) + 1, dtype=np.int64)
+        indices = []
+        for start in range(0, len(corpus), chunk_size):
+            for i, tokens in enumerate(tokenize_batch(corpus[start:start + chunk_size]), start):
+                keywords = []
+                for wd in tokens:
+                    if wd in keywords_dict and keywords_dict[wd] not in keywords:
+                        keywords.append(keywords_dict[wd])
+                indices.extend(keywords)
+                indptr[i + 1] = len(indices)
+        return cls(indptr, np.array(indices, dtype=np.int32))
+
+    def save(self, path):
+        tmp_path = path[:-len('.npz')] + '.tmp.npz'
+        np.savez(tmp_path, indptr=self.indptr, indices=self.indices)
+        os.replace(tmp_path, path)
+
+    @classmethod
+    def load(cls, path):
+        with np.load(path) as index:
+            return cls(index['indptr'], index['indices'])
+
+
+def load_keyword_index(data_config, tokenize_batch, corpus=None):
+    """Loads the keyword index of the corpus of `data_config`, building and
+    saving it first if it does not exist yet. `corpus` is the content of the
+    corpus files if it differs from `data_config._corpus`.
+    """
+    path = keyword_index_path(data_config.corpus_hparams['dataset']['files'], data_config._keywords_path, tokenize_batch)
+    if os.path.exists(path):
+        return CorpusKeywordIndex.load(path)
+    index = CorpusKeywordIndex.build(corpus or data_config._corpus, data_config._keywords_dict, tokenize_batch)
+    index.save(path)
+    return index
@@ -0,0 +1,268 @@
+import os
+import re
+import json
+import shutil
+import hashlib
+import texar as tx
+import tensorflow as tf
+from texar.data.data import dataset_utils as dsutils
+from utils.corpus_index import _update_hash
+
+_SHARD_SIZE = 100000
+
+
+def _split(text, delimiter):
+    # like tf.string_split, splits on every character of the delimiter and skips the empty tokens
+    return [x for x in re.split('[{}]'.format(re.escape(delimiter)), text) if x]
+
+
+def _read_lines(files):
+    lines = []
+    for path in files:
+        with open(path, 'r') as f:
+            lines.extend(x.rstrip('\n') for x in f)
+    return lines
+
+
+def _int64_feature(values):
+    return tf.train.Feature(int64_list=tf.train.Int64List(value=values))
+
+
+def _bytes_feature(values):
+    return tf.train.Feature(bytes_list=tf.train.BytesList(value=values))
+
+
+def _utterance_width(hparams):
+    # the utterances are padded to `max_seq_length` plus BOS/EOS when it is given
+    if hparams['length_filter_mode'] != 'truncate' or not hparams['max_seq_length']:
+        return None
+    return hparams['max_seq_length'] + bool(hparams['bos_token']) + bool(hparams['eos_token'])
+
+
+def _encode_text(line, hparams, vocab):
+    """Returns the items `TextDataDecoder` or `VarUttTextDataDecoder` would
+    decode from `line`, as features.
+    """
+    max_seq_length = hparams['max_seq_length'] if hparams['length_filter_mode'] == 'truncate' else None
+    bos = [hparams['bos_token']] if hparams['bos_token'] else []
+    eos = [hparams['eos_token']] if hparams['eos_token'] else []
+    token_to_id = vocab.token_to_id_map_py
+    unk_id = vocab.unk_token_id
+
+    def tokenize(text):
+        return bos + _split(text, hparams['delimiter'])[:max_seq_length] + eos
+
+    if not hparams['variable_utterance']:
+        tokens = tokenize(line)
+        return {'text': _bytes_feature([x.encode('utf-8') for x in tokens]),
+                'text_ids': _int64_feature([token_to_id.get(x, unk_id) for x in tokens]),
+                'length': _int64_feature([len(tokens)])}
+    utterances = [tokenize(x) for x in
+                  _split(line, hparams['utterance_delimiter'])[:hparams['max_utterance_cnt'] or None]]
+    width = _utterance_width(hparams) or max(map(len, utterances), default=0)
+    return {'text_ids': _int64_feature([token_to_id.get(x, unk_id) for tokens in utterances
+                                        for x in tokens + [vocab.pad_token] * (width - len(tokens))]),
+            'length': _int64_feature([len(tokens) for tokens in utterances]),
+            'utterance_cnt': _int64_feature([len(utterances)])}
+
+
+def pretokenized_data_path(datasets_hparams):
+    """Returns the directory of the pre-tokenized shards of the aligned
+    datasets of `datasets_hparams`, next to the files of the first one and
+    keyed by the content of all the dataset and vocabulary files and by their
+    processing hparams.
+    """
+    sha = hashlib.sha1()
+    for dataset_hparams in datasets_hparams:
+        for path in dataset_hparams['files']:
+            _update_hash(sha, path)
+        if dataset_hparams.get('vocab_file'):
+            _update_hash(sha, dataset_hparams['vocab_file'])
+        sha.update(json.dumps({k: v for k, v in dataset_hparams.items() if k != 'embedding_init'},
+                              sort_keys=True, default=str).encode('utf-8'))
+    return os.path.join(os.path.dirname(datasets_hparams[0]['files'][0]),
+                        'pretokenized_{}'.format(sha.hexdigest()[:16]))
+
+
+def write_pretokenized_data(datasets_hparams, vocabs, path, shard_size=_SHARD_SIZE):
+    """Writes the examples of the aligned datasets of `datasets_hparams` as
+    TFRecord shards of `shard_size` examples in the directory `path`, with
+    the token ids of the text datasets looked up in their `vocabs`.
+    """
+    columns = [_read_lines(x['files']) for x in datasets_hparams]
+    num_examples = min(len(x) for x in columns)
+    tmp_path = path + '.tmp'
+    if os.path.exists(tmp_path):
+        shutil.rmtree(tmp_path)
+    os.makedirs(tmp_path)
+    num_shards = max((num_examples + shard_size - 1) // shard_size, 1)
+    for shard_id in range(num_shards):
+        shard_path = os.path.join(tmp_path, 'part-{:05d}-of-{:05d}.tfrecord'.format(shard_id, num_shards))
+        with tf.python_io.TFRecordWriter(shard_path) as writer:
+            for i in range(shard_id * shard_size, min((shard_id + 1) * shard_size, num_examples)):
+                features = {}
+                for hparams_i, vocab_i, column in zip(datasets_hparams, vocabs, columns):
+                    name = hparams_i['data_name']
+                    if hparams_i['data_type'] == 'text':
+                        for item, feature in _encode_text(column[i], hparams_i, vocab_i).items():
+                            features['{}_{}'.format(name, item)] = feature
+                    elif hparams_i['data_type'] == 'int':
+                        features[name] = _int64_feature([int(column[i])])
+                    else:
+                        features[name] = tf.train.Feature(float_list=tf.train.FloatList(value=[float(column[i])]))
+                example = tf.train.Example(features=tf.train.Features(feature=features))
+                writer.write(example.SerializeToString())
+    os.rename(tmp_path, path)
+
+
+class PretokenizedData(tx.data.MultiAlignedData):
+    """`MultiAlignedData` that reads the examples from TFRecord shards holding
+    their token ids and lengths instead of parsing the text files, which are
+    converted once on first use. Takes the same hparams, of `text`, `int` and
+    `float` datasets only and without `other_transformations` or
+    `processing_share_with`, and gives the same batches, except the text of
+    the variable utterance datasets, which is not kept.
+    """
+    def _make_data(self):
+        datasets_hparams = self._hparams.datasets
+        for hparams_i in datasets_hparams:
+            if hparams_i.data_type not in ('text', 'int', 'float'):
+                raise ValueError("Unsupported data type of pre-tokenized data '{}': {}".format(
+                    hparams_i.data_name, hparams_i.data_type))
+            if hparams_i.data_type == 'text' and (hparams_i.other_transformations or
+                                                  hparams_i.processing_share_with is not None):
+                raise ValueError("Pre-tokenized data '{}' does not support 'other_transformations' "
+                                 "or 'processing_share_with'".format(hparams_i.data_name))
+        self._vocab = self.make_vocab(datasets_hparams)
+        self._embedding = self.make_embedding(datasets_hparams, self._vocab)
+        self._name_to_id = {x['data_name']: i for i, x in enumerate(datasets_hparams)}
+
+        path = pretokenized_data_path([x.todict() for x in datasets_hparams])
+        if not os.path.exists(path):
+            write_pretokenized_data([x.todict() for x in datasets_hparams], self._vocab, path)
+        dataset = tf.data.TFRecordDataset(sorted(
+            os.path.join(path, x) for x in os.listdir(path) if x.endswith('.tfrecord')))
+        dataset, self._dataset_size = self._shuffle_dataset(dataset, self._hparams, datasets_hparams[0].files)
+
+        # the decoders only give the names and the added lengths of the items,
+        # the shards are parsed by `_make_parse_fn` instead
+        data_spec = dsutils._DataSpec(dataset=dataset, dataset_size=self._dataset_size,
+                                      vocab=self._vocab, embedding=self._embedding)
+        _, data_spec = self._make_processor(datasets_hparams, data_spec, self._get_name_prefix(datasets_hparams))
+        self._data_spec = data_spec
+        self._decoder = data_spec.decoder
+
+        dataset = dataset.map(self._make_parse_fn(), num_parallel_calls=self._hparams.num_parallel_calls)
+        # the 'discard' datasets are written untruncated and filtered here, as texar does
+        filter_fn = self._make_length_filter(
+            datasets_hparams,
+            [self.length_name(i) if x.data_type == 'text' else None for i, x in enumerate(datasets_hparams)],
+            self._decoder)
+        if filter_fn:
+            dataset = dataset.filter(filter_fn)
+        dataset = dataset.take(self._hparams.max_dataset_size)
+        dataset = self._make_batch(dataset, self._hparams, self._make_bucket_length_fn(),
+                                   self._make_padded_shapes(dataset, self._decoder))
+        if self._hparams.prefetch_buffer_size > 0:
+            dataset = dataset.prefetch(self._hparams.prefetch_buffer_size)
+        self._dataset = dataset
+
+    def _make_parse_fn(self):
+        features = {}
+        for hparams_i in self._hparams.datasets:
+            name = hparams_i.data_name
+            if hparams_i.data_type == 'text':
+                features[name + '_text_ids'] = tf.VarLenFeature(tf.int64)
+                if hparams_i.variable_utterance:
+                    features[name + '_length'] = tf.VarLenFeature(tf.int64)
+                    features[name + '_utterance_cnt'] = tf.FixedLenFeature([], tf.int64)
+                else:
+                    features[name + '_length'] = tf.FixedLenFeature([], tf.int64)
+                    features[name + '_text'] = tf.VarLenFeature(tf.string)
+            elif hparams_i.data_type == 'int':
+                features[name] = tf.FixedLenFeature([], tf.int64)
+            else:
+                features[name] = tf.FixedLenFeature([], tf.float32)
+
+        def _parse(record):
+            example = tf.parse_single_example(record, features)
+            data = {}
+            for hparams_i in self._hparams.datasets:
+                name = hparams_i.data_name
+                if hparams_i.data_type == 'int':
+                    data[name] = tf.cast(example[name], tf.int32)
+                elif hparams_i.data_type == 'float':
+                    data[name] = example[name]
+                elif hparams_i.variable_utterance:
+                    utterance_cnt = tf.cast(example[name + '_utterance_cnt'], tf.int32)
+                    length = tf.cast(tf.sparse.to_dense(example[name + '_length']), tf.int32)
+                    text_ids = tf.sparse.to_dense(example[name + '_text_ids'])
+                    width = _utterance_width(hparams_i) or tf.size(text_ids) // tf.maximum(utterance_cnt, 1)
+                    data[name + '_text_ids'] = tf.reshape(text_ids, [utterance_cnt, width])
+                    data[name + '_length'] = length
+                    data[name + '_utterance_cnt'] = utterance_cnt
+                else:
+                    data[name + '_text'] = tf.sparse.to_dense(example[name + '_text'], default_value='')
+                    data[name + '_text_ids'] = tf.sparse.to_dense(example[name + '_text_ids'])
+                    data[name + '_length'] = tf.cast(example[name + '_length'], tf.int32)
+            return data
+        return _parse
+
+
+def compare_with_aligned_data(hparams):
+    """Returns the names of the items of which the first batch of
+    `PretokenizedData(hparams)` differs from the one of
+    `MultiAlignedData(hparams)`, or is missing.
+    """
+    with tf.Graph().as_default():
+        data, pretokenized_data = tx.data.MultiAlignedData(hparams), PretokenizedData(hparams)
+        batch = data.dataset.make_one_shot_iterator().get_next()
+        pretokenized_batch = pretokenized_data.dataset.make_one_shot_iterator().get_next()
+        with tf.Session() as sess:
+            sess.run(tf.tables_initializer())
+            batch, pretokenized_batch = sess.run([batch, pretokenized_batch])
+    # the text of the variable utterance datasets is not kept
+    skipped = {data.text_name(i) for i, x in enumerate(data.hparams.datasets)
+               if x.data_type == 'text' and x.variable_utterance}
+    return sorted(name for name in batch if name not in skipped and
+                  (name not in pretokenized_batch or batch[name].shape != pretokenized_batch[name].shape or
+                   (batch[name] != pretokenized_batch[name]).any()))
+
+
+def make_aligned_data(data_config, stage):
+    """Returns the aligned datasets of `stage` of `data_config`, read from the
+    pre-tokenized shards when `data_config._pretokenized_data` is set.
+    """
+    if data_config._pretokenized_data:
+        return PretokenizedData(data_config.data_hparams[stage])
+    return tx.data.MultiAlignedData(data_config.data_hparams[stage])
+
+
+if __name__ == '__main__':
+    # checks the pre-tokenized batches against texar on a toy aligned dataset
+    import tempfile
+    with tempfile.TemporaryDirectory() as data_root:
+        files = {'vocab.txt': 'i\nlike\ndogs\ncats\nyou\n',
+                 'source.txt': 'i like dogs|||you like cats too\nyou|||i like\ncats\n',
+                 'keywords.txt': 'dogs cats\nlike\nyou i like dogs cats\n',
+                 'label.txt': '1\n0\n1\n'}
+        for name, content in files.items():
+            with open(os.path.join(data_root, name), 'w') as f:
+                f.write(content)
+        for length_filter_mode in ['truncate', 'discard']:
+            toy_hparams = {
+                'num_epochs': 1,
+                'shuffle': False,
+                'batch_size': 3,
+                'datasets': [
+                    {'variable_utterance': True, 'max_utterance_cnt': 2, 'max_seq_length': 3,
+                     'files': [os.path.join(data_root, 'source.txt')],
+                     'vocab_file': os.path.join(data_root, 'vocab.txt'), 'data_name': 'source'},
+                    {'max_seq_length': 4, 'length_filter_mode': length_filter_mode,
+                     'files': [os.path.join(data_root, 'keywords.txt')], 'vocab_share_with': 0,
+                     'bos_token': '', 'eos_token': '', 'data_name': 'keywords'},
+                    {'files': [os.path.join(data_root, 'label.txt')], 'data_type': 'int', 'data_name': 'label'},
+                ]
+            }
+            mismatches = compare_with_aligned_data(toy_hparams)
+            print('{}: {}'.format(length_filter_mode, 'mismatches {}'.format(mismatches) if mismatches else 'ok'))
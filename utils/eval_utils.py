@@ -0,0 +1,110 @@
+import queue
+import threading
+from collections import OrderedDict
+import numpy as np
+
+
+class KeywordMetrics:
+    """Accuracy and recall@k of the keyword prediction.
+
+    The recall@k is the number of the top-k predicted keywords found in the
+    keywords of their example over the number of those keywords, both summed
+    over the whole test set.
+    """
+    def __init__(self, ks=(1, 3, 5)):
+        self.ks = sorted(ks)
+        self.num_examples = 0
+        self.acc_sum = 0.
+        self.num_keywords = 0
+        self.hits = np.zeros(len(self.ks), dtype=np.int64)
+
+    def update(self, acc, kw_ans, kw_labels):
+        """Adds a batch of mean accuracy `acc`, top-k keyword ids `kw_ans` of
+        shape `[batch_size, max(ks)]` and label keyword ids `kw_labels` of
+        shape `[batch_size, num_labels]`.
+        """
+        if max(self.ks) > kw_ans.shape[1]:
+            raise ValueError('recall@{} needs the top-{} keywords, but only {} were predicted'.format(
+                max(self.ks), max(self.ks), kw_ans.shape[1]))
+        self.num_examples += len(kw_ans)
+        self.acc_sum += acc * len(kw_ans)
+        # ids 0-3 are the padding and special tokens
+        self.num_keywords += np.sum(kw_labels > 3)
+        hits = np.any(kw_ans[:, :, None] == kw_labels[:, None, :], axis=2)
+        hits = np.cumsum(np.sum(hits, axis=0))
+        self.hits += hits[np.array(self.ks) - 1]
+
+    def result(self):
+        result = OrderedDict([('acc@1', self.acc_sum / self.num_examples)])
+        for k, hits in zip(self.ks, self.hits):
+            result['rec@{}'.format(k)] = hits / self.num_keywords
+        return result
+
+
+class RankMetrics:
+    """Recall@k and MRR of the response retrieval among the candidates."""
+    def __init__(self, ks=(1, 3, 5)):
+        self.ks = sorted(ks)
+        self.num_candidates = None
+        self.num_examples = 0
+        self.hits = np.zeros(len(self.ks), dtype=np.int64)
+        self.rr_sum = 0.
+
+    def update(self, ranks, labels):
+        """Adds a batch of candidate ids `ranks` of shape `[batch_size,
+        num_candidates]`, sorted by decreasing score, and of the ids `labels`
+        of the true responses.
+        """
+        self.num_candidates = ranks.shape[1]
+        self.num_examples += len(ranks)
+        rank = np.argmax(ranks == np.expand_dims(labels, 1), axis=1)
+        self.hits += np.sum(rank[:, None] < np.array(self.ks), axis=0)
+        self.rr_sum += np.sum(1 / (rank + 1))
+
+    def result(self):
+        result = OrderedDict()
+        for k, hits in zip(self.ks, self.hits):
+            result['rec{}@{}'.format(k, self.num_candidates)] = hits / self.num_examples
+        result['MRR'] = self.rr_sum / self.num_examples
+        return result
+
+
+class StreamingEvaluator:
+    """Updates `metrics` with the batches passed to `add` in a worker thread,
+    so that computing the metrics of a batch overlaps with `sess.run` of the
+    next one.
+    """
+    def __init__(self, metrics):
+        self.metrics = metrics
+        self._error = None
+        self._queue = queue.Queue()
+        self._worker = threading.Thread(target=self._run, daemon=True)
+        self._worker.start()
+
+    def add(self, *batch):
+        self._queue.put(batch)
+
+    def result(self):
+        """Waits for the pending batches and returns the metrics as an ordered
+        dict. Exceptions raised while updating the metrics are re-raised here.
+        """
+        self._queue.put(None)
+        self._worker.join()
+        if self._error is not None:
+            raise self._error
+        return self.metrics.result()
+
+    def _run(self):
+        while True:
+            batch = self._queue.get()
+            if batch is None:
+                break
+            if self._error is None:
+                try:
+                    self.metrics.update(*batch)
+                except Exception as e:
+                    self._error = e
+
+
+def format_metrics(result):
+    return ', '.join('{}={:.4f}'.format(name, value) for name, value in result.items())
@@ -0,0 +1,87 @@
+import os
+import hashlib
+import numpy as np
+from utils.corpus_index import _update_hash
+
+
+def keyword_graph_path(data_root, keywords_path, stages=('train', 'valid', 'test')):
+    """Returns the path of the keyword graphs of `stages`, in `data_root` and
+    keyed by their `context.txt` / `keywords.txt` files and the keyword
+    vocabulary, which fixes the node ids.
+    """
+    sha = hashlib.sha1()
+    _update_hash(sha, keywords_path)
+    for stage in stages:
+        _update_hash(sha, os.path.join(data_root, stage, 'context.txt'))
+        _update_hash(sha, os.path.join(data_root, stage, 'keywords.txt'))
+    return os.path.join(data_root, 'keyword_graph_{}.npz'.format(sha.hexdigest()[:16]))
+
+
+class KeywordGraph:
+    """Keyword knowledge graph as a CSR adjacency matrix: an edge `i -> j`
+    means that keyword `j` is in the next keywords of a context holding
+    keyword `i`.
+    """
+    def __init__(self, size, indptr, indices):
+        self.size = size
+        self.indptr = indptr
+        self.indices = indices
+
+    def __len__(self):
+        return len(self.indices)
+
+    def edges(self):
+        """Returns the `(rows, cols)` of the edges, sorted in row-major order."""
+        return np.repeat(np.arange(self.size), np.diff(self.indptr)), self.indices
+
+    @classmethod
+    def build(cls, context_keywords_list, next_keywords_list, stoi):
+        """Builds the graph of the `(context keywords, next keywords)` pairs of
+        each example, with the node ids of the keywords given by `stoi`.
+        """
+        def to_ids(keywords_list):
+            lengths = np.array([len(keywords) for keywords in keywords_list], dtype=np.int64)
+            ids = np.array([stoi[kw] for keywords in keywords_list for kw in keywords], dtype=np.int64)
+            return ids, lengths
+
+        num_examples = min(len(context_keywords_list), len(next_keywords_list))
+        context_ids, context_lengths = to_ids(context_keywords_list[:num_examples])
+        next_ids, next_lengths = to_ids(next_keywords_list[:num_examples])
+        next_starts = np.cumsum(next_lengths) - next_lengths
+        # every context keyword is paired with all the next keywords of its example
+        fanout = np.repeat(next_lengths, context_lengths)
+        rows = np.repeat(context_ids, fanout)
+        pair_starts = np.cumsum(fanout) - fanout
+        cols = next_ids[np.repeat(np.repeat(next_starts, context_lengths), fanout) +
+                        np.arange(fanout.sum()) - np.repeat(pair_starts, fanout)]
+        size = len(stoi)
+        keys = np.unique(rows * size + cols)
+        indptr = np.concatenate([[0], np.cumsum(np.bincount(keys // size, minlength=size))])
+        return cls(size, indptr, (keys % size).astype(np.int32))
+
+
+def load_keyword_graphs(data_root, keywords_path, stoi, stages=('train', 'valid', 'test')):
+    """Returns `{stage: KeywordGraph}` built from the files of `stages` in
+    `data_root`, loaded from the `.npz` cache when it exists and saved to it
+    otherwise.
+    """
+    path = keyword_graph_path(data_root, keywords_path, stages)
+    if os.path.exists(path):
+        with np.load(path) as cache:
+            return {stage: KeywordGraph(int(cache['size']), cache[stage + '_indptr'], cache[stage + '_indices'])
+                    for stage in stages}
+    graphs = {}
+    for stage in stages:
+        with open(os.path.join(data_root, stage, 'context.txt'), 'r') as f:
+            context_keywords_list = [x.strip().split() for x in f.readlines()]
+        with open(os.path.join(data_root, stage, 'keywords.txt'), 'r') as f:
+            next_keywords_list = [x.strip().split() for x in f.readlines()]
+        graphs[stage] = KeywordGraph.build(context_keywords_list, next_keywords_list, stoi)
+    arrays = {'size': len(stoi)}
+    for stage, graph in graphs.items():
+        arrays[stage + '_indptr'] = graph.indptr
+        arrays[stage + '_indices'] = graph.indices
+    tmp_path = path[:-len('.npz')] + '.tmp.npz'
+    np.savez(tmp_path, **arrays)
+    os.replace(tmp_path, path)
+    return graphs
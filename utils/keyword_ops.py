@@ -0,0 +1,26 @@
+import tensorflow as tf
+
+_NUM_SPECIAL = 4
+
+
+def keyword_labels(keywords_ids, kw_vocab_size):
+    """Returns the multi-hot labels of shape `[batch_size, kw_vocab_size - 4]`
+    of the keyword ids `keywords_ids` of each example, without the special
+    tokens of the keyword vocabulary.
+    """
+    labels = tf.reduce_sum(tf.one_hot(keywords_ids, kw_vocab_size), axis=1)
+    return tf.minimum(labels, 1.)[:, _NUM_SPECIAL:]
+
+
+def keyword_accuracy(kw_labels, kw_ans):
+    """Returns the rate of the predicted keywords `kw_ans` that are in the
+    labels `kw_labels` of their example.
+    """
+    return tf.reduce_mean(tf.batch_gather(kw_labels, tf.expand_dims(kw_ans, 1)))
+
+
+def keyword_token_ids(kw_list, kw_indices):
+    """Maps the keyword indices `kw_indices`, of any shape, to their token
+    ids in `kw_list`.
+    """
+    return tf.gather(kw_list, kw_indices)
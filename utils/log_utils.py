@@ -1,26 +1,145 @@
 import os
+import json
+import time
+import queue
+import atexit
+import threading
 
 
-def create_logs(logs_path):
+class AsyncLogger:
+    """Appends log lines to a file from a background thread.
+
+    `log` only puts the lines into a bounded queue, so the calling thread
+    never waits for the disk. The worker thread writes everything pending
+    with one `write` call, rotates the file once it exceeds `max_bytes`
+    (keeping `backup_count` old files as `path.1`, `path.2`, ...), and
+    optionally writes one JSON object per line. Lines are dropped (and the
+    number of dropped lines logged) when the queue is full.
+
+    Args:
+        path: Path of the log file.
+        max_queue: Maximum number of pending `log` calls.
+        max_bytes: Size in bytes after which the file is rotated. `None`
+            disables rotation.
+        backup_count: Number of rotated files to keep.
+        jsonl: Whether to write `{"time", "message", **fields}` JSON lines
+            instead of plain lines.
+    """
+    def __init__(self, path, max_queue=10000, max_bytes=100 * 1024 * 1024, backup_count=5, jsonl=False):
+        self.path = path
+        self.max_bytes = max_bytes
+        self.backup_count = backup_count
+        self.jsonl = jsonl
+        self.dropped = 0
+        # `dropped` is counted by the calling threads and reset by the worker
+        self._dropped_lock = threading.Lock()
+        self._queue = queue.Queue(max_queue)
+        self._worker = threading.Thread(target=self._run, daemon=True)
+        self._worker.start()
+
+    def log(self, contents, **fields):
+        """Queues `contents` (a line or a list of lines). `fields` are added to
+        every record in JSONL mode and ignored otherwise, and cannot be named
+        `time` or `message`.
+        """
+        if isinstance(contents, str):
+            contents = [contents]
+        reserved = {'time', 'message'} & set(fields)
+        if reserved:
+            raise ValueError('log fields {} are reserved'.format(sorted(reserved)))
+        try:
+            self._queue.put_nowait((time.time(), contents, fields))
+        except queue.Full:
+            with self._dropped_lock:
+                self.dropped += 1
+
+    def flush(self):
+        """Blocks until all queued lines are written."""
+        self._queue.join()
+
+    def _format(self, record):
+        timestamp, contents, fields = record
+        if not self.jsonl:
+            return ''.join(content + '\n' for content in contents)
+        return ''.join(json.dumps(dict(time=timestamp, message=content, **fields), ensure_ascii=False, default=str) + '\n'
+                       for content in contents)
+
+    def _rotate(self):
+        for i in range(self.backup_count - 1, 0, -1):
+            if os.path.exists('{}.{}'.format(self.path, i)):
+                os.replace('{}.{}'.format(self.path, i), '{}.{}'.format(self.path, i + 1))
+        if self.backup_count > 0:
+            os.replace(self.path, self.path + '.1')
+        else:
+            os.remove(self.path)
+
+    def _run(self):
+        while True:
+            records = [self._queue.get()]
+            while True:
+                try:
+                    records.append(self._queue.get_nowait())
+                except queue.Empty:
+                    break
+            lines = []
+            for record in records:
+                try:
+                    lines.append(self._format(record))
+                except Exception as e:
+                    # a bad record is skipped, so that the worker keeps running
+                    print('failed to format a log record of {}: {}'.format(self.path, e))
+            with self._dropped_lock:
+                dropped, self.dropped = self.dropped, 0
+            if dropped:
+                lines.append(self._format((time.time(), ['[{} log records dropped]'.format(dropped)], {})))
+            try:
+                with open(self.path, 'a') as logs:
+                    logs.write(''.join(lines))
+                if self.max_bytes is not None and os.path.getsize(self.path) > self.max_bytes:
+                    self._rotate()
+            except Exception as e:
+                print('failed to write logs to {}: {}'.format(self.path, e))
+            for _ in records:
+                self._queue.task_done()
+
+
+_loggers = {}
+_loggers_lock = threading.Lock()
+
+
+def get_logger(logs_path, **kwargs):
+    """Returns the `AsyncLogger` of `logs_path`, created with `kwargs` on the
+    first call.
+    """
+    with _loggers_lock:
+        if logs_path not in _loggers:
+            _loggers[logs_path] = AsyncLogger(logs_path, **kwargs)
+        return _loggers[logs_path]
+
+
+@atexit.register
+def flush_logs():
+    for logger in list(_loggers.values()):
+        logger.flush()
+
+
+def create_logs(logs_path, **kwargs):
     dir_path = os.path.dirname(logs_path)
     if not os.path.exists(dir_path):
         os.makedirs(dir_path)
     logs = open(logs_path, "a+")
     logs.close()
+    return get_logger(logs_path, **kwargs)
 
 
-def add_logs(logs_path, logs_contents, print_details=True):
-    logs = open(logs_path, "a")
-    for logs_content in logs_contents:
-        if print_details:
+def add_logs(logs_path, logs_contents, print_details=True, **fields):
+    if print_details:
+        for logs_content in logs_contents:
             print(logs_content)
-        logs.write(logs_content + '\n')
-    logs.close()
+    get_logger(logs_path).log(list(logs_contents), **fields)
 
 
-def add_log(logs_path, logs_content, print_details=True):
-    logs = open(logs_path, "a")
+def add_log(logs_path, logs_content, print_details=True, **fields):
     if print_details:
         print(logs_content)
-    logs.write(logs_content + '\n')
-    logs.close()
+    get_logger(logs_path).log(logs_content, **fields)
@@ -0,0 +1,92 @@
+import os
+import time
+import threading
+from collections import deque
+import numpy as np
+
+
+def agent_labels(module_name):
+    """Returns the metric labels of the agent defined in `module_name` (e.g.
+    `model.neural_dkr`) for the dataset selected by `is_weibo`.
+    """
+    return {'agent': module_name.rsplit('.', 1)[-1],
+            'dataset': 'CWC' if os.environ.get('is_weibo') == 'True' else 'TGPC'}
+
+
+class LatencyHistogram:
+    """Latency samples of one stage: total count and sum, and the most recent
+    `window` samples, from which the quantiles are computed.
+    """
+    def __init__(self, window=10000):
+        self.count = 0
+        self.sum = 0.
+        self.samples = deque(maxlen=window)
+
+    def observe(self, seconds):
+        self.count += 1
+        self.sum += seconds
+        self.samples.append(seconds)
+
+
+class StageTimer:
+    """Times consecutive stages: `lap(stage)` records the time elapsed since the
+    previous lap (or the creation of the timer) under `stage`.
+    """
+    def __init__(self, registry, labels):
+        self.registry = registry
+        self.labels = labels
+        self.start = self.last = time.time()
+
+    def lap(self, stage):
+        now = time.time()
+        self.registry.observe(stage, now - self.last, **self.labels)
+        self.last = now
+
+    def total(self, stage='total'):
+        self.registry.observe(stage, time.time() - self.start, **self.labels)
+
+
+class MetricsRegistry:
+    """Thread-safe per-(agent, dataset, stage) latency histograms."""
+    def __init__(self, window=10000):
+        self.window = window
+        self._histograms = {}
+        self._lock = threading.Lock()
+
+    def observe(self, stage, seconds, agent='', dataset=''):
+        key = (agent, dataset, stage)
+        with self._lock:
+            if key not in self._histograms:
+                self._histograms[key] = LatencyHistogram(self.window)
+            self._histograms[key].observe(seconds)
+
+    def timer(self, agent='', dataset=''):
+        return StageTimer(self, {'agent': agent, 'dataset': dataset})
+
+    def snapshot(self):
+        """Returns `{(agent, dataset, stage): {'count', 'sum', 'p50', 'p95',
+        'p99'}}` with the latencies in seconds.
+        """
+        with self._lock:
+            histograms = [(key, histogram.count, histogram.sum, list(histogram.samples))
+                          for key, histogram in self._histograms.items()]
+        snapshot = {}
+        for key, count, total, samples in histograms:
+            p50, p95, p99 = np.percentile(samples, [50, 95, 99]) if samples else (0., 0., 0.)
+            snapshot[key] = {'count': count, 'sum': total, 'p50': p50, 'p95': p95, 'p99': p99}
+        return snapshot
+
+    def render(self):
+        """Returns the snapshot in the Prometheus text exposition format."""
+        lines = ['# TYPE tgodc_stage_latency_seconds summary']
+        for (agent, dataset, stage), stats in sorted(self.snapshot().items()):
+            labels = 'agent="{}",dataset="{}",stage="{}"'.format(agent, dataset, stage)
+            for quantile, name in [('0.5', 'p50'), ('0.95', 'p95'), ('0.99', 'p99')]:
+                lines.append('tgodc_stage_latency_seconds{{{},quantile="{}"}} {:.6f}'.format(
+                    labels, quantile, stats[name]))
+            lines.append('tgodc_stage_latency_seconds_sum{{{}}} {:.6f}'.format(labels, stats['sum']))
+            lines.append('tgodc_stage_latency_seconds_count{{{}}} {}'.format(labels, stats['count']))
+        return '\n'.join(lines) + '\n'
+
+
+metrics = MetricsRegistry()
@@ -0,0 +1,131 @@
+import os
+import numpy as np
+from multiprocessing import Pool
+
+_UNK_ID, _NUM_SPECIAL = 3, 4
+
+# set in each worker by `_init_worker`, so that the dicts are sent once per process
+_token_to_id = None
+_keywords_dict = None
+
+
+def _init_worker(token_to_id, keywords_dict):
+    global _token_to_id, _keywords_dict
+    _token_to_id, _keywords_dict = token_to_id, keywords_dict
+
+
+def _read_lines(path):
+    with open(path, 'r') as f:
+        return [x.strip() for x in f.readlines()]
+
+
+def count_cooccurrences(context_lines, keywords_lines, token_to_id, keywords_dict):
+    """Counts the `(context word, next keyword)` pairs of each example.
+
+    The context words are given the vocabulary ids of the datasets (the
+    unknown ones count as UNK) and the next keywords their index in the
+    keyword candidates, those out of the candidates being dropped. Returns
+    the distinct pairs, as `row * len(keywords_dict) + col` keys, and their
+    counts.
+    """
+    context_ids, context_lengths = [], []
+    for line in context_lines:
+        tokens = line.split()
+        context_ids.extend(token_to_id.get(token, _UNK_ID) for token in tokens)
+        context_lengths.append(len(tokens))
+    next_ids, next_lengths = [], []
+    for line in keywords_lines:
+        ids = [keywords_dict[token] for token in line.split() if token in keywords_dict]
+        next_ids.extend(ids)
+        next_lengths.append(len(ids))
+    context_ids = np.array(context_ids, dtype=np.int64)
+    context_lengths = np.array(context_lengths, dtype=np.int64)
+    next_ids = np.array(next_ids, dtype=np.int64)
+    next_lengths = np.array(next_lengths, dtype=np.int64)
+
+    # every context word is paired with all the next keywords of its example
+    next_starts = np.cumsum(next_lengths) - next_lengths
+    fanout = np.repeat(next_lengths, context_lengths)
+    rows = np.repeat(context_ids, fanout)
+    pair_starts = np.cumsum(fanout) - fanout
+    cols = next_ids[np.repeat(np.repeat(next_starts, context_lengths), fanout) +
+                    np.arange(fanout.sum()) - np.repeat(pair_starts, fanout)]
+    keys, counts = np.unique(rows * len(keywords_dict) + cols, return_counts=True)
+    return keys, counts
+
+
+def _count_shard(shard):
+    return count_cooccurrences(shard[0], shard[1], _token_to_id, _keywords_dict)
+
+
+class PMIMatrix:
+    """Log word-keyword matrix of the matrix agent.
+
+    Only the pairs seen in the training data are stored, as a CSR matrix of
+    shape `[vocab_size, num_keywords]` holding the offsets of their log value
+    from the log value `default[j]` that every unseen pair of keyword `j`
+    has.
+    """
+    def __init__(self, default, indptr, indices, data):
+        self.default = default
+        self.indptr = indptr
+        self.indices = indices
+        self.data = data
+
+    def __len__(self):
+        return len(self.data)
+
+    @property
+    def shape(self):
+        return len(self.indptr) - 1, len(self.default)
+
+    def to_dense(self):
+        matrix = np.repeat(self.default[None, :], self.shape[0], axis=0)
+        matrix[np.repeat(np.arange(self.shape[0]), np.diff(self.indptr)), self.indices] += self.data
+        return matrix
+
+
+def build_pmi_matrix(data_config, stage='train', processes=1, shard_size=100000):
+    """Builds the log word-keyword matrix of the matrix agent from the
+    `context.txt` / `keywords.txt` files of `stage`.
+
+    The value of `[i, j]` is the smoothed count of the contexts holding the
+    word of id `i` followed by the keyword `j`, normalized over the words.
+    The examples are counted in shards of `shard_size` lines by `processes`
+    processes, all CPUs when None.
+    """
+    vocab = _read_lines(data_config._vocab_path)
+    token_to_id = {token: i + _NUM_SPECIAL for i, token in enumerate(vocab)}
+    context_lines = _read_lines(os.path.join(data_config.data_root, stage, 'context.txt'))
+    keywords_lines = _read_lines(os.path.join(data_config.data_root, stage, 'keywords.txt'))
+    num_examples = min(len(context_lines), len(keywords_lines))
+    shards = [(context_lines[i:i + shard_size], keywords_lines[i:i + shard_size])
+              for i in range(0, max(num_examples, 1), shard_size)]
+
+    if processes == 1:
+        counts = [count_cooccurrences(context, keywords, token_to_id, data_config._keywords_dict)
+                  for context, keywords in shards]
+    else:
+        with Pool(processes, initializer=_init_worker,
+                  initargs=(token_to_id, data_config._keywords_dict)) as pool:
+            counts = pool.map(_count_shard, shards)
+    keys, inverse = np.unique(np.concatenate([x[0] for x in counts]), return_inverse=True)
+    counts = np.bincount(inverse, weights=np.concatenate([x[1] for x in counts]), minlength=len(keys))
+    num_rows, num_keywords = len(vocab) + _NUM_SPECIAL, data_config._keywords_num
+    rows, cols = keys // num_keywords, keys % num_keywords
+    # every pair is smoothed by 0.5, so an unseen one is worth 0.5 / (column sum + 1)
+    col_sums = np.bincount(cols, weights=counts, minlength=num_keywords) + 0.5 * num_rows
+    default = np.log(0.5 / (col_sums + 1)).astype(np.float32)
+    indptr = np.concatenate([[0], np.cumsum(np.bincount(rows, minlength=num_rows))])
+    return PMIMatrix(default, indptr, cols.astype(np.int32), np.log1p(2 * counts).astype(np.float32))
+
+
+def save_pmi_matrix(matrix, path):
+    tmp_path = path[:-len('.npz')] + '.tmp.npz'
+    np.savez(tmp_path, default=matrix.default, indptr=matrix.indptr, indices=matrix.indices, data=matrix.data)
+    os.replace(tmp_path, path)
+
+
+def load_pmi_matrix(path):
+    with np.load(path) as f:
+        return PMIMatrix(f['default'], f['indptr'], f['indices'], f['data'])
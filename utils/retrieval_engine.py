@@ -0,0 +1,55 @@
+import numpy as np
+
+
+def top_k(scores, k):
+    """Returns the indices of the `k` largest `scores` along the last axis,
+    sorted by descending score.
+
+    Ties are broken by the lower index first, as `tf.nn.top_k` does.
+    """
+    k = min(k, scores.shape[-1])
+    if k < scores.shape[-1]:
+        candidates = np.argpartition(-scores, k - 1, axis=-1)[..., :k]
+    else:
+        candidates = np.broadcast_to(np.arange(k), scores.shape)
+    candidate_scores = np.take_along_axis(scores, candidates, axis=-1)
+    # lexsort sorts by the last key first: score descending, then index
+    order = np.lexsort((candidates, -candidate_scores), axis=-1)
+    return np.take_along_axis(candidates, order, axis=-1)
+
+
+class MIPSEngine:
+    """Exact maximum inner product search over the corpus codes.
+
+    The response matcher of every agent is a single linear layer applied to
+    `corpus_code * history_code`, so the score of a corpus entry is
+    `corpus_code . (w * history_code) + b`. A batch of queries is scored with
+    one matrix product against the contiguous float32 `corpus_code`, and only
+    the top `k` entries are sorted.
+
+    Args:
+        corpus_code: Array of shape `[corpus_size, code_len]`. Memory-mapped
+            float32 indexes are used in place.
+        weight: Kernel of the linear matcher, of shape `[code_len, 1]`.
+        bias: Bias of the linear matcher, of shape `[1]`.
+    """
+    def __init__(self, corpus_code, weight, bias):
+        self.corpus_code = np.ascontiguousarray(corpus_code, dtype=np.float32)
+        self.weight = np.asarray(weight, dtype=np.float32).reshape(-1)
+        self.bias = np.float32(np.asarray(bias).reshape(-1)[0])
+
+    def __len__(self):
+        return len(self.corpus_code)
+
+    def score(self, queries):
+        """Returns the matcher scores of shape `[batch_size, corpus_size]` for
+        the history codes `queries` of shape `[batch_size, code_len]`.
+        """
+        queries = np.asarray(queries, dtype=np.float32) * self.weight
+        return np.dot(queries, self.corpus_code.T) + self.bias
+
+    def search(self, queries, k):
+        """Returns the indices of shape `[batch_size, k]` of the best `k` corpus
+        entries for each of `queries`, best first.
+        """
+        return top_k(self.score(queries), k)
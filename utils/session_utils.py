@@ -0,0 +1,87 @@
+import time
+import uuid
+import threading
+from collections import OrderedDict
+
+
+class ChatSession:
+    """Conversation state of one client of the chat server.
+
+    Holds everything `Predictor.retrieve` reads or updates between turns
+    (target, score, reply set, next keyword) together with the dialogue
+    history and its tokenized form, so that concurrent conversations do not
+    overwrite each other.
+    """
+    def __init__(self, session_id, target, start_utterance):
+        self.session_id = session_id
+        self.target = target
+        self.score = 0.
+        self.reply_list = []
+        self.next_kw = None
+        self.start_utterance = start_utterance
+        self.history = []
+        self.history_tokens = []
+        self.current_turns = 0
+        self.lock = threading.Lock()
+        self.last_access = time.time()
+
+    def append(self, utterance, tokens):
+        self.history.append(utterance)
+        self.history_tokens.append(tokens)
+
+
+class SessionStore:
+    """Thread-safe session container with LRU and TTL eviction.
+
+    Args:
+        capacity: Maximum number of live sessions. The least recently used
+            session is evicted when a new one would exceed it.
+        ttl: Seconds of inactivity after which a session expires.
+    """
+    def __init__(self, capacity=1000, ttl=1800):
+        self.capacity = capacity
+        self.ttl = ttl
+        self._sessions = OrderedDict()
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def new_session_id():
+        return uuid.uuid4().hex
+
+    def get(self, session_id):
+        """Returns the live session of `session_id` and marks it as recently
+        used, or `None` if it does not exist or has expired.
+        """
+        now = time.time()
+        with self._lock:
+            self._evict_expired(now)
+            session = self._sessions.get(session_id)
+            if session is None:
+                return None
+            session.last_access = now
+            self._sessions.move_to_end(session_id)
+            return session
+
+    def put(self, session):
+        with self._lock:
+            self._evict_expired(time.time())
+            self._sessions[session.session_id] = session
+            self._sessions.move_to_end(session.session_id)
+            while len(self._sessions) > self.capacity:
+                self._sessions.popitem(last=False)
+
+    def pop(self, session_id):
+        with self._lock:
+            return self._sessions.pop(session_id, None)
+
+    def _evict_expired(self, now):
+        # sessions are kept in access order, so expired ones are at the front
+        while self._sessions:
+            session = next(iter(self._sessions.values()))
+            if now - session.last_access <= self.ttl:
+                break
+            self._sessions.popitem(last=False)
+
+    def __len__(self):
+        with self._lock:
+            return len(self._sessions)
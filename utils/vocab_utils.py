@@ -0,0 +1,20 @@
+import texar as tx
+
+
+def load_vocab(data_config):
+    """Returns the vocabulary of the dialogue datasets of `data_config`
+    without building the datasets.
+    """
+    return tx.data.Vocab(data_config.data_hparams['test']['datasets'][0]['vocab_file'])
+
+
+def build_word_embedder(data_config, vocab, train_data=None, hparams=None):
+    """Returns a `WordEmbedder` initialized with the pretrained embeddings of
+    `train_data`, or an uninitialized one of the same shape when `train_data`
+    is None, i.e. when the embeddings are restored from a checkpoint and
+    reading the embedding file can be skipped.
+    """
+    if train_data is not None:
+        return tx.modules.WordEmbedder(init_value=train_data.embedding_init_value(0).word_vecs, hparams=hparams)
+    dim = data_config.data_hparams['test']['datasets'][0]['embedding_init']['dim']
+    return tx.modules.WordEmbedder(vocab_size=vocab.size, hparams=dict(hparams or {}, dim=dim))